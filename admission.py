@@ -0,0 +1,96 @@
+import time
+import threading
+import collections
+
+
+class Rejections:
+    ClientLimit = "client_limit"
+    QueueFull = "queue_full"
+    QueueTimeout = "queue_timeout"
+
+
+class AdmissionController:
+    """
+    Bounds the scoring requests served at the same time, the requests waiting for them and the requests of each client.
+    A request over a limit is rejected right away (or after max_wait in the queue), so that under overload
+    the server sheds the extra load instead of letting every request time out
+    """
+    def __init__(self, max_in_flight=0, max_pending=100, max_per_client=0, max_wait=30, pending_gauge=None, in_flight_gauge=None):
+        """
+        @param max_in_flight: the requests served at the same time, 0 for no limit
+        @param max_pending: the requests waiting for one of the max_in_flight places
+        @param max_per_client: the requests served or waiting of each client, 0 for no limit
+        @param max_wait: the longest time in seconds a request waits in the queue
+        @param pending_gauge, in_flight_gauge: gauges (with set) kept at the number of waiting and served requests
+        """
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.max_per_client = max_per_client
+        self.max_wait = max_wait
+        self.pending_gauge = pending_gauge
+        self.in_flight_gauge = in_flight_gauge
+        self.in_flight = 0
+        self.pending = 0
+        self.clients = collections.Counter()
+        self.condition = threading.Condition()
+
+    def set_request_threads(self, threads):
+        """
+        Caps max_pending to the request threads left by the served requests: a waiting request holds its thread,
+        so beyond them the requests would wait unseen in the connection queue of the server instead of being rejected
+        @param threads: the threads serving the requests in this process
+        @return the new max_pending
+        """
+        with self.condition:
+            if self.max_in_flight > 0:
+                self.max_pending = min(self.max_pending, max(threads - self.max_in_flight, 0))
+            return self.max_pending
+
+    def update_gauges(self):
+        if self.pending_gauge is not None:
+            self.pending_gauge.set(self.pending)
+        if self.in_flight_gauge is not None:
+            self.in_flight_gauge.set(self.in_flight)
+
+    def admit(self, client):
+        """
+        Waits for a place if all of them are taken, the admitted requests must call release
+        @return None if the request is admitted, the Rejections reason otherwise
+        """
+        with self.condition:
+            if self.max_per_client > 0 and self.clients[client] >= self.max_per_client:
+                return Rejections.ClientLimit
+            if self.max_in_flight > 0 and self.in_flight >= self.max_in_flight:
+                if self.pending >= self.max_pending:
+                    return Rejections.QueueFull
+                self.clients[client] += 1
+                self.pending += 1
+                self.update_gauges()
+                deadline = time.monotonic() + self.max_wait
+                try:
+                    while self.in_flight >= self.max_in_flight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.remove_client(client)
+                            return Rejections.QueueTimeout
+                        self.condition.wait(remaining)
+                finally:
+                    self.pending -= 1
+                    self.update_gauges()
+            else:
+                self.clients[client] += 1
+            self.in_flight += 1
+            self.update_gauges()
+            return None
+
+    def remove_client(self, client):
+        self.clients[client] -= 1
+        if self.clients[client] <= 0:
+            del self.clients[client]
+
+    def release(self, client):
+        with self.condition:
+            self.in_flight -= 1
+            self.remove_client(client)
+            self.update_gauges()
+            self.condition.notify()
@@ -0,0 +1,97 @@
+import os
+import time
+import threading
+import collections
+import concurrent.futures
+
+
+class MicroBatcher:
+    """
+    Gathers the texts submitted by concurrent requests into batches for a batched model function.
+    A batch is dispatched when it reaches max_batch_size texts or when its oldest text has waited max_wait seconds,
+    whichever comes first, then the results are split back to the waiting requests.
+    The texts of a request are never split, a request larger than max_batch_size is a batch on its own
+    """
+    def __init__(self, batch_fun, max_batch_size=64, max_wait=0.01, dispatchers=1, name="batcher", queue_gauge=None):
+        """
+        @param batch_fun: function(texts) returning the list of results, one per text
+        @param max_wait: the longest time in seconds a text waits for other texts before its batch is dispatched
+        @param dispatchers: the number of batches running at the same time
+        @param queue_gauge: a gauge (with inc and dec) kept at the number of texts waiting for a batch
+        """
+        self.batch_fun = batch_fun
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.dispatchers = dispatchers
+        self.name = name
+        self.queue_gauge = queue_gauge
+        self.pending = collections.deque()
+        self.pending_texts = 0
+        self.condition = threading.Condition()
+        self.pid = None
+
+    def start(self):
+        # the dispatchers start with the first text, in the process serving the requests (threads do not survive a fork)
+        for i in range(self.dispatchers):
+            threading.Thread(target=self.run, name=f"{self.name}-{i}", daemon=True).start()
+        self.pid = os.getpid()
+
+    def submit(self, texts):
+        """
+        @return the future of the list of results of the texts
+        """
+        future = concurrent.futures.Future()
+        texts = list(texts)
+        if not texts:
+            future.set_result([])
+            return future
+        with self.condition:
+            if self.pid != os.getpid():
+                self.start()
+            self.pending.append((time.monotonic(), texts, future))
+            self.pending_texts += len(texts)
+            if self.queue_gauge is not None:
+                self.queue_gauge.inc(len(texts))
+            self.condition.notify()
+        return future
+
+    def next_batch(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            deadline = self.pending[0][0] + self.max_wait
+            while self.pending_texts < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+                if not self.pending: # taken by another dispatcher
+                    return []
+            batch, size = [], 0
+            while self.pending and (not batch or size + len(self.pending[0][1]) <= self.max_batch_size):
+                batch.append(self.pending.popleft())
+                size += len(batch[-1][1])
+            self.pending_texts -= size
+            if self.queue_gauge is not None:
+                self.queue_gauge.dec(size)
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                results = self.batch_fun([text for _, texts, _ in batch for text in texts])
+            except Exception:
+                # one bad submission must not fail the others of its batch: each one runs again on its own
+                for _, texts, future in batch:
+                    try:
+                        future.set_result(self.batch_fun(texts))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            offset = 0
+            for _, texts, future in batch:
+                future.set_result(results[offset:offset+len(texts)])
+                offset += len(texts)
@@ -3,6 +3,7 @@ from hashlib import sha256
 from os import urandom
 from itertools import cycle
 from io import BytesIO
+import numpy as np
 
 # RFC 3526 - More Modular Exponential (MODP) Diffie-Hellman groups for
 # Internet Key Exchange (IKE) https://tools.ietf.org/html/rfc3526
@@ -261,8 +262,15 @@ def decrypt(encrypted_message, key: str):
         return xor_encrypt_decrypt(str(encrypted_message), key)
 
         
-def xore(data, key):
-    return bytes(a ^ b for a, b in zip(data, cycle(key)))
+def xore(data, key, offset=0):
+    """
+    XOR of data with the key repeated, starting from the byte offset of the key.
+    A stream XORed block by block, with the offset of each block in the stream, is the same as the whole stream XORed at once
+    """
+    if len(data) == 0:
+        return bytes(data)
+    key = np.roll(np.frombuffer(key, dtype=np.uint8), -(offset % len(key)))
+    return (np.frombuffer(data, dtype=np.uint8) ^ np.resize(key, len(data))).tobytes()
 
 
 def encrypt_data(data, key):
@@ -280,4 +288,15 @@ def encrypt_file(file_binary_data, key_string):
 def encrypt_decrypt_file(file_binary_data, key_string):
     with BytesIO(file_binary_data) as df:
         data = xore(df.read(), bytes(key_string, encoding='utf8'))
-    return data
\ No newline at end of file
+    return data
+
+def encrypt_decrypt_chunk(chunk_binary_data, key_string, offset):
+    return xore(chunk_binary_data, bytes(key_string, encoding='utf8'), offset)
+
+def encrypt_decrypt_file_stream(input_filename, output_filename, key_string, block_size=1<<20):
+    # the file is processed in blocks, so it is never fully loaded in memory
+    offset = 0
+    with open(input_filename, 'rb') as in_file, open(output_filename, 'wb') as out_file:
+        for block in iter(lambda: in_file.read(block_size), b''):
+            out_file.write(encrypt_decrypt_chunk(block, key_string, offset))
+            offset += len(block)
@@ -0,0 +1,197 @@
+"""
+Chunked readers and streaming writers of the files scored by /getStatsFile and the jobs.
+The columnar formats (Parquet, Arrow) only decode the projected columns.
+Arrow and Parquet need pyarrow
+"""
+import os
+import json
+import numbers
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa, pq = None, None
+
+
+class FileFormats:
+    Csv = "csv"
+    Jsonl = "jsonl"
+    Parquet = "parquet"
+    Arrow = "arrow"
+
+EXTENSION_FORMATS = {'csv': FileFormats.Csv, 'txt': FileFormats.Csv, 'dat': FileFormats.Csv,
+                     'json': FileFormats.Jsonl, 'jsonl': FileFormats.Jsonl, 'ndjson': FileFormats.Jsonl,
+                     'parquet': FileFormats.Parquet, 'arrow': FileFormats.Arrow, 'feather': FileFormats.Arrow}
+OUTPUT_FORMATS = [FileFormats.Csv, FileFormats.Jsonl, FileFormats.Parquet]
+MIMETYPES = {FileFormats.Csv: 'text/csv', FileFormats.Jsonl: 'application/x-ndjson', FileFormats.Parquet: 'application/vnd.apache.parquet'}
+OUTPUT_EXTENSIONS = {FileFormats.Csv: 'csv', FileFormats.Jsonl: 'jsonl', FileFormats.Parquet: 'parquet'}
+
+
+def get_file_format(filename):
+    extension = os.path.splitext(filename)[1].lower().lstrip('.')
+    if extension not in EXTENSION_FORMATS:
+        raise ValueError(f"Unrecognized file extension: {extension}")
+    return EXTENSION_FORMATS[extension]
+
+
+def check_pyarrow(file_format):
+    if pa is None:
+        raise ImportError(f"The {file_format} format needs pyarrow, install it with pip install pyarrow")
+
+
+def get_file_columns(file_path, file_format):
+    if file_format == FileFormats.Csv:
+        return list(pd.read_csv(file_path, nrows=0).columns)
+    elif file_format == FileFormats.Jsonl:
+        with open(file_path, encoding='utf8') as f:
+            for line in f:
+                if line.strip():
+                    return list(json.loads(line).keys())
+        return []
+    return get_file_schema(file_path, file_format).names
+
+
+def get_file_schema(file_path, file_format, usecols=None):
+    """
+    @param usecols: the columns of the schema, all of them if None
+    @return the Arrow schema of a Parquet or Arrow file
+    """
+    check_pyarrow(file_format)
+    if file_format == FileFormats.Parquet:
+        schema = pq.read_schema(file_path)
+    else:
+        with pa.memory_map(file_path) as source:
+            schema = pa.ipc.open_file(source).schema
+    if usecols is not None:
+        schema = pa.schema([schema.field(col) for col in usecols])
+    return schema
+
+
+def count_file_rows(file_path, file_format, txt_col):
+    """
+    @return the number of rows of the file, read from the metadata of the columnar formats and by reading txt_col otherwise
+    """
+    if file_format == FileFormats.Parquet:
+        check_pyarrow(file_format)
+        return pq.ParquetFile(file_path).metadata.num_rows
+    elif file_format == FileFormats.Arrow:
+        check_pyarrow(file_format)
+        with pa.memory_map(file_path) as source:
+            reader = pa.ipc.open_file(source)
+            return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+    return sum(len(chunk_df) for chunk_df in read_file_chunks(file_path, file_format, usecols=[txt_col], chunk_size=10000))
+
+
+def read_file_chunks(file_path, file_format, usecols=None, chunk_size=1000):
+    """
+    Reads the file in dataframes of at most chunk_size rows
+    @param usecols: the columns to read, all of them if None
+    """
+    if file_format == FileFormats.Csv:
+        yield from pd.read_csv(file_path, usecols=usecols, chunksize=chunk_size)
+    elif file_format == FileFormats.Jsonl:
+        # every line is parsed whole, the projection only drops the other columns
+        for chunk_df in pd.read_json(file_path, lines=True, chunksize=chunk_size, dtype=False):
+            yield chunk_df if usecols is None else chunk_df[[col for col in chunk_df.columns if col in usecols]]
+    elif file_format == FileFormats.Parquet:
+        check_pyarrow(file_format)
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunk_size, columns=usecols):
+            yield batch.to_pandas()
+    else:
+        check_pyarrow(file_format)
+        # memory-mapped, the batches of the other columns are never read
+        with pa.memory_map(file_path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                if usecols is not None:
+                    batch = batch.select(usecols)
+                for start in range(0, batch.num_rows, chunk_size):
+                    yield batch.slice(start, chunk_size).to_pandas()
+
+
+def _is_number(value):
+    return value is None or value is pd.NA or (isinstance(value, numbers.Number) and not isinstance(value, bool))
+
+
+def fix_dtypes(chunk_df, string_cols=(), float_cols=()):
+    """
+    Gives the columns of a chunk dtypes that do not depend on its values, so that every chunk of a file
+    has the Parquet schema of the first one (a column empty or mixed in a chunk would otherwise change type).
+    The other columns keep their dtypes, a chunk that still does not match the schema fails the write
+    @param string_cols: the columns made strings, the missing values stay missing
+    @param float_cols: the columns made float64, strings if they hold anything else than numbers
+    """
+    chunk_df = chunk_df.copy()
+    for col in string_cols:
+        chunk_df[col] = chunk_df[col].astype("string")
+    for col in float_cols:
+        if pd.api.types.is_numeric_dtype(chunk_df[col]) and not pd.api.types.is_bool_dtype(chunk_df[col]) or chunk_df[col].map(_is_number).all():
+            chunk_df[col] = chunk_df[col].astype("float64")
+        else:
+            chunk_df[col] = chunk_df[col].astype("string")
+    return chunk_df
+
+
+class _BytesSink:
+    """
+    File-like object collecting what ParquetWriter writes, so that it can be sent while the file is written
+    """
+    def __init__(self):
+        self.blocks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.blocks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def pop(self):
+        data = b''.join(self.blocks)
+        self.blocks = []
+        return data
+
+
+def write_file_chunks(chunks, file_format, schema=None):
+    """
+    Serializes the dataframes in the output file format. The Parquet schema is the one of the first dataframe,
+    the others are cast to it (see fix_dtypes) and an incompatible column raises
+    @param schema: the Parquet types of some of the columns (e.g. the schema of the input file), they override the ones of the first dataframe
+    @return a generator of bytes, the concatenation is the whole file
+    """
+    if file_format == FileFormats.Csv:
+        for i, chunk_df in enumerate(chunks):
+            yield chunk_df.to_csv(header=i == 0).encode('utf8')
+    elif file_format == FileFormats.Jsonl:
+        for chunk_df in chunks:
+            if len(chunk_df) > 0:
+                yield (chunk_df.to_json(orient='records', lines=True).rstrip('\n') + '\n').encode('utf8')
+    elif file_format == FileFormats.Parquet:
+        check_pyarrow(file_format)
+        sink = _BytesSink()
+        writer = None
+        for chunk_df in chunks:
+            if writer is None:
+                inferred = pa.Table.from_pandas(chunk_df, preserve_index=False).schema
+                if schema is not None:
+                    inferred = pa.schema([schema.field(name) if name in schema.names else inferred.field(name) for name in inferred.names])
+                writer = pq.ParquetWriter(sink, inferred)
+            table = pa.Table.from_pandas(chunk_df, schema=writer.schema, preserve_index=False)
+            writer.write_table(table) # one row group per chunk
+            yield sink.pop()
+        if writer is not None:
+            writer.close()
+            yield sink.pop()
+    else:
+        raise ValueError(f"Unsupported output format: {file_format}, use one of {OUTPUT_FORMATS}")
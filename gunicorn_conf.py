@@ -0,0 +1,18 @@
+import sys
+from metrics import mark_process_dead
+
+# sudo PROMETHEUS_MULTIPROC_DIR=/tmp/nlp_metrics gunicorn3 -c gunicorn_conf.py --preload -b 0.0.0.0:5000 wsgi:app
+# empty PROMETHEUS_MULTIPROC_DIR before every start
+
+def child_exit(server, worker):
+    mark_process_dead(worker.pid)
+
+def post_worker_init(worker):
+    # the inference workers and the job threads start in each worker once the app is loaded, never in the master (--preload),
+    # so the unfinished jobs resume without waiting for a request
+    server = sys.modules.get("nlp_flask_server")
+    if server is not None:
+        server.start_workers()
+        # the requests waiting for admission hold a thread of the worker (--threads)
+        max_pending = server.admission.set_request_threads(worker.cfg.threads)
+        worker.log.info(f"Admission control: at most {max_pending} requests waiting with {worker.cfg.threads} threads")
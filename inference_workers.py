@@ -0,0 +1,114 @@
+"""
+Inference-server mode: a pool of long-lived worker processes owning the models.
+The workers are forked from the process serving the requests on the first use (never from the gunicorn master),
+after the models are loaded, so they start with the models in memory (shared with the server until written),
+each with its own torch threads and optionally pinned to its own cores.
+The server only parses the requests and sends the texts of each model group to the workers over the pool queues
+"""
+import os
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+import concurrent.futures.process
+
+
+_worker_models = None
+_worker_logger = None
+
+
+def _init_worker(torch_threads, cpu_sets):
+    global _worker_logger
+    _worker_logger = logging.getLogger("inference_worker")
+    if cpu_sets is not None:
+        cpus = cpu_sets.get()
+        if cpus and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+    if torch_threads is not None and torch_threads > 0:
+        import torch
+        torch.set_num_threads(torch_threads)
+
+
+def _run_model_group(model_names, texts):
+    return {model_name: _worker_models[model_name](texts, _worker_logger) for model_name in model_names}
+
+
+def _ready():
+    return os.getpid()
+
+
+class InferencePool:
+    def __init__(self, models_map, workers, torch_threads=1, pin_cpus=False, logger=None):
+        """
+        @param models_map: the model name -> batched model function map of the Engine, inherited by the workers
+        @param workers: the number of worker processes
+        @param torch_threads: the torch intra-op threads of each worker
+        @param pin_cpus: to pin each worker to its own torch_threads cores
+        """
+        self.models_map = models_map
+        self.workers = workers
+        self.torch_threads = torch_threads
+        self.pin_cpus = pin_cpus
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+
+    def get_cpu_sets(self, mp_context):
+        if not self.pin_cpus or not hasattr(os, "sched_getaffinity"):
+            return None
+        cpus = sorted(os.sched_getaffinity(0))
+        per_worker = max(self.torch_threads or 1, 1)
+        cpu_sets = mp_context.Queue()
+        for i in range(self.workers):
+            # more workers than cores wrap around
+            start = (i * per_worker) % len(cpus)
+            cpu_sets.put({cpus[(start + j) % len(cpus)] for j in range(per_worker)})
+        return cpu_sets
+
+    def start(self):
+        """
+        Forks all the workers now, call it (through get_executor) before the server starts its threads
+        """
+        global _worker_models
+        _worker_models = self.models_map
+        mp_context = multiprocessing.get_context("fork")
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context, initializer=_init_worker,
+                                                              initargs=(self.torch_threads, self.get_cpu_sets(mp_context)))
+        pids = {future.result() for future in [self.executor.submit(_ready) for _ in range(self.workers)]}
+        self.pid = os.getpid()
+        if self.logger is not None:
+            self.logger.info(f"Started {self.workers} inference workers {sorted(pids)}")
+
+    def get_executor(self):
+        with self.lock:
+            # the pool starts in the process using it, a pool created before a fork (e.g. gunicorn --preload) would not work in the child
+            if self.pid != os.getpid():
+                self.start()
+            return self.executor
+
+    def restart(self, broken_executor):
+        with self.lock:
+            # a worker died (e.g. killed for memory): the pool is broken for good, the first thread noticing it forks new workers
+            if self.executor is broken_executor:
+                if self.logger is not None:
+                    self.logger.error(f"Inference workers pool broken, restarting {self.workers} workers")
+                broken_executor.shutdown(wait=False)
+                self.start()
+            return self.executor
+
+    def submit(self, model_names, texts):
+        """
+        @return the future of the model name -> list of results map of the model group
+        """
+        executor = self.get_executor()
+        try:
+            return executor.submit(_run_model_group, list(model_names), list(texts))
+        except concurrent.futures.process.BrokenProcessPool:
+            return self.restart(executor).submit(_run_model_group, list(model_names), list(texts))
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
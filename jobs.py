@@ -0,0 +1,275 @@
+import os
+import json
+import time
+import contextlib
+import uuid
+import sqlite3
+import threading
+import concurrent.futures
+from file_formats import read_file_chunks
+
+
+class JobStatus:
+    Queued = "queued"
+    Running = "running"
+    Done = "done"
+    Failed = "failed"
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobStore():
+    """
+    In-process store of the scoring jobs: their metadata, their inputs and their results so far.
+    The inputs are a list of texts, or an uploaded file left on disk until the job ends and read chunk by chunk.
+    With a db_path every change is also written to a local SQLite database, so the jobs (and the results
+    of their completed chunks) survive a restart, and the results are read from the database instead of being kept in memory.
+    The finished jobs are removed ttl seconds after they end
+    """
+    def __init__(self, db_path=None, json_encoder=None, ttl=24*3600):
+        self.jobs = {}
+        self.inputs = {}
+        self.results = {}
+        self.lock = threading.Lock()
+        self.db_path = db_path
+        self.json_encoder = json_encoder
+        self.ttl = ttl
+        if self.db_path is not None:
+            self.init_db()
+            self.load_db()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def init_db(self):
+        with self.transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, method TEXT, owner TEXT, status TEXT, total INTEGER, processed INTEGER, error TEXT, created REAL, updated REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS job_inputs (job_id TEXT PRIMARY KEY, texts TEXT, text_ids TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS job_files (job_id TEXT PRIMARY KEY, file_path TEXT, file_format TEXT, txt_col TEXT)")
+            db.execute("CREATE TABLE IF NOT EXISTS job_results (job_id TEXT, chunk INTEGER, results TEXT, PRIMARY KEY (job_id, chunk))")
+
+    def load_db(self):
+        # only the metadata of the jobs and the inputs of the unfinished ones, the results stay in the database
+        with self.transaction() as db:
+            for row in db.execute("SELECT job_id, method, owner, status, total, processed, error, created, updated FROM jobs"):
+                job = dict(zip(["job_id", "method", "owner", "status", "total", "processed", "error", "created", "updated"], row))
+                self.jobs[job["job_id"]] = job
+            for job_id, texts, text_ids in db.execute("SELECT job_id, texts, text_ids FROM job_inputs"):
+                self.inputs[job_id] = {"texts": json.loads(texts), "text_ids": json.loads(text_ids)}
+            for job_id, file_path, file_format, txt_col in db.execute("SELECT job_id, file_path, file_format, txt_col FROM job_files"):
+                self.inputs[job_id] = {"file_path": file_path, "file_format": file_format, "txt_col": txt_col}
+
+    def save_job(self, db, job):
+        db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (job["job_id"], job["method"], job["owner"], job["status"], job["total"], job["processed"], job["error"], job["created"], job["updated"]))
+
+    def create(self, inputs, total, method, owner):
+        """
+        @param inputs: {"texts": [...], "text_ids": [...]} or {"file_path": ..., "file_format": ..., "txt_col": ...}
+        @param total: the number of texts of the inputs
+        """
+        now = time.time()
+        job = {"job_id": uuid.uuid4().hex, "method": method, "owner": owner, "status": JobStatus.Queued,
+               "total": total, "processed": 0, "error": None, "created": now, "updated": now}
+        with self.lock:
+            self.jobs[job["job_id"]] = job
+            self.inputs[job["job_id"]] = inputs
+            if self.db_path is not None:
+                with self.transaction() as db:
+                    self.save_job(db, job)
+                    if "file_path" in inputs:
+                        db.execute("INSERT INTO job_files VALUES (?, ?, ?, ?)", (job["job_id"], inputs["file_path"], inputs["file_format"], inputs["txt_col"]))
+                    else:
+                        db.execute("INSERT INTO job_inputs VALUES (?, ?, ?)", (job["job_id"], json.dumps(inputs["texts"]), json.dumps(inputs["text_ids"], cls=self.json_encoder)))
+            else:
+                self.results[job["job_id"]] = []
+            return dict(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def get_inputs(self, job_id):
+        with self.lock:
+            return self.inputs.get(job_id)
+
+    def get_results(self, job_id, start=0):
+        if self.db_path is None:
+            with self.lock:
+                return self.results.get(job_id, [])[start:]
+        results = []
+        with self.transaction() as db:
+            # the chunks are keyed by the index of their first text
+            for chunk, chunk_results in db.execute("SELECT chunk, results FROM job_results WHERE job_id = ? ORDER BY chunk", (job_id,)):
+                chunk_results = json.loads(chunk_results)
+                if chunk + len(chunk_results) > start:
+                    results.extend(chunk_results[max(start - chunk, 0):])
+        return results
+
+    def count_unfinished(self):
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job["status"] in [JobStatus.Queued, JobStatus.Running])
+
+    def unfinished(self):
+        with self.lock:
+            return [job_id for job_id, job in self.jobs.items() if job["status"] in [JobStatus.Queued, JobStatus.Running]]
+
+    def add_results(self, job_id, results, processed):
+        with self.lock:
+            job = self.jobs[job_id]
+            chunk = job["processed"]
+            job["processed"] += processed
+            job["updated"] = time.time()
+            if self.db_path is not None:
+                with self.transaction() as db:
+                    db.execute("INSERT OR REPLACE INTO job_results VALUES (?, ?, ?)", (job_id, chunk, json.dumps(results, cls=self.json_encoder)))
+                    self.save_job(db, job)
+            else:
+                self.results[job_id].extend(results)
+
+    def set_status(self, job_id, status, error=None):
+        with self.lock:
+            job = self.jobs[job_id]
+            job["status"] = status
+            job["error"] = error
+            job["updated"] = time.time()
+            if status in [JobStatus.Done, JobStatus.Failed]:
+                inputs = self.inputs.pop(job_id, None)
+                if inputs is not None and "file_path" in inputs:
+                    try:
+                        os.remove(inputs["file_path"])
+                    except OSError:
+                        pass
+            if self.db_path is not None:
+                with self.transaction() as db:
+                    self.save_job(db, job)
+                    if status in [JobStatus.Done, JobStatus.Failed]:
+                        db.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+                        db.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+
+    def evict_expired(self):
+        """
+        Removes the jobs finished more than ttl seconds ago, with their results
+        """
+        expiry = time.time() - self.ttl
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items() if job["status"] in [JobStatus.Done, JobStatus.Failed] and job["updated"] < expiry]
+            for job_id in expired:
+                self.jobs.pop(job_id, None)
+                self.results.pop(job_id, None)
+            if expired and self.db_path is not None:
+                with self.transaction() as db:
+                    db.executemany("DELETE FROM jobs WHERE job_id = ?", [(job_id,) for job_id in expired])
+                    db.executemany("DELETE FROM job_results WHERE job_id = ?", [(job_id,) for job_id in expired])
+        return expired
+
+
+class JobManager():
+    """
+    Runs the jobs of a JobStore on a bounded pool of worker threads, chunk by chunk.
+    The pool starts in the process serving the requests (threads do not survive a fork, e.g. gunicorn --preload),
+    then the jobs left unfinished by a previous run are resumed from their last completed chunk
+    """
+    def __init__(self, score_fun, store, workers=2, chunk_size=256, max_pending_jobs=100, logger=None, queue_gauge=None):
+        """
+        @param score_fun: function(texts, text_ids, method) returning the list of results of a chunk
+        @param store: the JobStore
+        @param workers: the number of jobs running at the same time
+        @param chunk_size: the number of texts scored at once, the progress and the partial results are updated after each chunk
+        @param max_pending_jobs: the maximum number of queued and running jobs, submit raises JobQueueFull beyond it
+        @param queue_gauge: a gauge (with set) kept at the number of queued and running jobs
+        """
+        self.score_fun = score_fun
+        self.store = store
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_pending_jobs = max_pending_jobs
+        self.logger = logger
+        self.queue_gauge = queue_gauge
+        self.submit_lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+
+    def start(self):
+        """
+        Starts the pool and resumes the unfinished jobs, once per process
+        """
+        with self.submit_lock:
+            if self.pid == os.getpid():
+                return self.executor
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+            self.pid = os.getpid()
+            self.store.evict_expired()
+            for job_id in self.store.unfinished():
+                self.executor.submit(self.run, job_id)
+        self.update_queue_gauge()
+        return self.executor
+
+    def update_queue_gauge(self):
+        if self.queue_gauge is not None:
+            self.queue_gauge.set(self.store.count_unfinished())
+
+    def submit(self, texts, text_ids, method, owner):
+        return self.submit_inputs({"texts": list(texts), "text_ids": list(text_ids)}, len(texts), method, owner)
+
+    def submit_file(self, file_path, file_format, txt_col, total, method, owner):
+        """
+        The job owns the file from now on, it is read chunk by chunk while the job runs and removed when it ends
+        @param total: the number of rows of the file
+        """
+        return self.submit_inputs({"file_path": file_path, "file_format": file_format, "txt_col": txt_col}, total, method, owner)
+
+    def submit_inputs(self, inputs, total, method, owner):
+        executor = self.start()
+        with self.submit_lock:
+            self.store.evict_expired()
+            if self.store.count_unfinished() >= self.max_pending_jobs:
+                raise JobQueueFull(f"Too many pending jobs ({self.max_pending_jobs}), try again later")
+            job = self.store.create(inputs, total, method, owner)
+        self.update_queue_gauge()
+        executor.submit(self.run, job["job_id"])
+        return job
+
+    def iter_chunks(self, inputs, start):
+        """
+        @return a generator of the (texts, text_ids) chunks of the inputs, from the text start on
+        """
+        if "file_path" not in inputs:
+            for chunk_start in range(start, len(inputs["texts"]), self.chunk_size):
+                yield inputs["texts"][chunk_start:chunk_start+self.chunk_size], inputs["text_ids"][chunk_start:chunk_start+self.chunk_size]
+            return
+        # the rows before start were scored before a restart, they are read again but not scored
+        row = 0
+        for chunk_df in read_file_chunks(inputs["file_path"], inputs["file_format"], usecols=[inputs["txt_col"]], chunk_size=self.chunk_size):
+            texts = chunk_df[inputs["txt_col"]].astype(str).tolist()
+            skip = min(max(start - row, 0), len(texts))
+            if skip < len(texts):
+                yield texts[skip:], list(range(row + skip, row + len(texts)))
+            row += len(texts)
+
+    def run(self, job_id):
+        try:
+            job = self.store.get(job_id)
+            inputs = self.store.get_inputs(job_id)
+            if inputs is None:
+                raise ValueError(f"The inputs of job {job_id} are missing")
+            self.store.set_status(job_id, JobStatus.Running)
+            for texts, text_ids in self.iter_chunks(inputs, job["processed"]):
+                results = self.score_fun(texts, text_ids, job["method"])
+                self.store.add_results(job_id, results, len(texts))
+            self.store.set_status(job_id, JobStatus.Done)
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error(f"Exception in job {job_id}: {e}")
+            self.store.set_status(job_id, JobStatus.Failed, str(e))
+        finally:
+            self.update_queue_gauge()
@@ -0,0 +1,57 @@
+"""
+Memory of the gunicorn workers serving the NLP server: sends N requests, then reports the
+unique (USS), proportional (PSS) and resident (RSS) memory of the master and of each worker.
+The USS of a worker is what it does not share with the others, compare it with and without prefork_share:
+    sudo gunicorn3 -c gunicorn_conf.py --preload --workers 8 -b 0.0.0.0:5000 wsgi:app
+    python measure_memory.py -p [gunicorn master PID] -u http://localhost:5000 -n 200
+Reading the memory of the processes of another user needs sudo
+"""
+import time
+import requests
+import psutil
+from argparse import ArgumentParser
+
+
+SAMPLE_TEXTS = ["I really enjoyed working with the team on this project, thanks for the support!",
+                "This is the worst meeting I have ever attended, nobody listens.",
+                "Can we discuss the budget tomorrow morning? I need your advice on the new plan."]
+
+
+def send_requests(url, requests_no, texts_per_request):
+    texts = [SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)] for i in range(texts_per_request)]
+    start = time.perf_counter()
+    for _ in range(requests_no):
+        response = requests.post(f"{url}/getStats", data={"text": texts, "id": list(range(len(texts))), "no_encryption": True})
+        response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def memory_mb(process):
+    info = process.memory_full_info()
+    return {"uss": info.uss / 2**20, "pss": getattr(info, "pss", 0) / 2**20, "rss": info.rss / 2**20}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-p', '--pid', type=int, required=True, help='PID of the gunicorn master')
+    parser.add_argument('-u', '--url', type=str, default='http://localhost:5000')
+    parser.add_argument('-n', '--requests', type=int, default=100, help='requests sent before measuring, 0 to measure right away')
+    parser.add_argument('-t', '--texts', type=int, default=16, help='texts per request')
+    args = parser.parse_args()
+
+    if args.requests > 0:
+        elapsed = send_requests(args.url, args.requests, args.texts)
+        print(f"{args.requests} requests of {args.texts} texts in {elapsed:.1f} s")
+
+    master = psutil.Process(args.pid)
+    workers = master.children()
+    print(f"{'process':>16s}\t{'USS MB':>10s}\t{'PSS MB':>10s}\t{'RSS MB':>10s}")
+    total = memory_mb(master)
+    print(f"{'master ' + str(master.pid):>16s}\t{total['uss']:10.1f}\t{total['pss']:10.1f}\t{total['rss']:10.1f}")
+    for worker in workers:
+        memory = memory_mb(worker)
+        for key in total:
+            total[key] += memory[key]
+        print(f"{'worker ' + str(worker.pid):>16s}\t{memory['uss']:10.1f}\t{memory['pss']:10.1f}\t{memory['rss']:10.1f}")
+    # the PSS splits the shared pages among the processes, its sum is the real memory of the server
+    print(f"{'total':>16s}\t{total['uss']:10.1f}\t{total['pss']:10.1f}\t{total['rss']:10.1f}")
@@ -0,0 +1,72 @@
+"""
+Prometheus metrics of the server, exposed by /metrics. They need prometheus_client, without it they do nothing.
+Under gunicorn set PROMETHEUS_MULTIPROC_DIR to an empty directory before the start: every worker writes its
+metrics there and /metrics sums them across the workers (see gunicorn_conf.py)
+"""
+import os
+import contextlib
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Histogram, Gauge, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+except ImportError:
+    prometheus_client = None
+
+
+class _NullMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return contextlib.nullcontext()
+
+
+def multiprocess_dir():
+    return os.environ.get('PROMETHEUS_MULTIPROC_DIR', os.environ.get('prometheus_multiproc_dir'))
+
+
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+if prometheus_client is not None:
+    REQUEST_LATENCY = Histogram('nlp_request_duration_seconds', 'Latency of the requests, until the last byte of the response', ['endpoint'])
+    REQUESTS = Counter('nlp_requests', 'Requests by endpoint and status code', ['endpoint', 'code'])
+    IN_FLIGHT = Gauge('nlp_requests_in_flight', 'Requests being served', multiprocess_mode='livesum')
+    MODEL_LATENCY = Histogram('nlp_model_duration_seconds', 'Latency of a call of a model function of Engine.models_map', ['model'])
+    MODEL_BATCH_SIZES = Histogram('nlp_model_batch_size', 'Texts passed to a model function at once', ['model'], buckets=SIZE_BUCKETS)
+    MODEL_TEXTS = Counter('nlp_model_texts', 'Texts scored by each model, rate() gives the texts per second', ['model'])
+    CRYPTO_LATENCY = Histogram('nlp_crypto_duration_seconds', 'Time spent decrypting and encrypting texts and files', ['operation'])
+    QUEUE_DEPTH = Gauge('nlp_queue_depth', 'Work waiting or running in the queues of the server', ['queue'], multiprocess_mode='livesum')
+    REJECTED = Counter('nlp_rejected_requests', 'Requests rejected by the admission control', ['reason'])
+else:
+    REQUEST_LATENCY = REQUESTS = IN_FLIGHT = MODEL_LATENCY = MODEL_BATCH_SIZES = MODEL_TEXTS = CRYPTO_LATENCY = QUEUE_DEPTH = REJECTED = _NullMetric()
+
+
+def generate_metrics():
+    """
+    @return the metrics in the Prometheus text format and their content type, None if prometheus_client is not installed
+    """
+    if prometheus_client is None:
+        return None, None
+    if multiprocess_dir() is not None:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    # the live gauges of a dead worker must not be summed anymore
+    if prometheus_client is not None and multiprocess_dir() is not None:
+        multiprocess.mark_process_dead(pid)
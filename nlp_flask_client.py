@@ -6,9 +6,11 @@ import json
 import utils
 import csv
 import datetime
+import time
 import concurrent.futures
 import socket
 from dh_encryption import DiffieHellman, decrypt_data, encrypt_data, decrypt_file, encrypt_file
+from serialization import dumps, loads, JSON_MIMETYPE, MSGPACK_MIMETYPES
 from io import BytesIO
 
 # using the generated key
@@ -22,7 +24,7 @@ from io import BytesIO
 # https://medium.com/hackernoon/3x-faster-than-flask-8e89bfbe8e4f
 
 class NLPClient():
-    def __init__(self, server_ip, server_port, keys_url="request-keys", request_shared_key="request-shared-key", stats_url="getStats", file_stats_url="getStatsFile", socket_port=-1):
+    def __init__(self, server_ip, server_port, keys_url="request-keys", request_shared_key="request-shared-key", stats_url="getStats", file_stats_url="getStatsFile", socket_port=-1, body_format="form"):
         self.server_ip = server_ip
         self.server_port = server_port
         self.base_url =  f"http://{self.server_ip}:{self.server_port}"
@@ -32,6 +34,7 @@ class NLPClient():
         self.keys = None
         self.stats_url = f"{self.base_url}/{stats_url}"
         self.file_stats_url = f"{self.base_url}/{file_stats_url}"
+        self.body_format = body_format # form, json or msgpack: how the texts are sent and the stats received
         self.socket = None if socket_port < 0 else self.init_socket(self.server_ip, self.socket_port)
         self.write_csv_headers = True
         self.output_df = None
@@ -87,6 +90,19 @@ class NLPClient():
     def socket_send_all_json(self, s, payload):
         socket.sendall(json.dumps(payload).encode('utf-8'))
 
+    def post_stats(self, payload, max_retries=10):
+        # the server answers 429 with a Retry-After when it is overloaded or this client has too many requests running
+        for _ in range(max_retries):
+            if self.body_format == "form":
+                response = requests.post(self.stats_url, data=payload)
+            else:
+                mimetype = JSON_MIMETYPE if self.body_format == "json" else MSGPACK_MIMETYPES[0]
+                response = requests.post(self.stats_url, data=dumps(payload, mimetype), headers={"Content-Type": mimetype, "Accept": mimetype})
+            if response.status_code != 429:
+                break
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+        return response
+
     def get_text_stats(self, text_data, no_encryption=False, index_list=None):        
         if not no_encryption:
             text_data = encrypt_data(text_data, self.keys["shared_key"])
@@ -96,9 +112,12 @@ class NLPClient():
             payload={'text': text_data, "no_encryption":no_encryption}
         try:          
             if self.socket is None:
-                response = requests.post(self.stats_url, data=payload)
+                response = self.post_stats(payload)
+                if self.body_format == "form":
+                    data = response.json()
+                else:
+                    data = loads(response.content, response.headers.get("Content-Type", JSON_MIMETYPE).split(';')[0])
                 # print(response.text)
-                data = response.json()
                 # print(f"Req: {data}")
             else:
                 # socket_send(socket, json.dumps(payload).encode('utf-8'))
@@ -152,7 +171,7 @@ class NLPClient():
         return sliced_df
 
     def encrypt_decrypt_file(self, input_filename, new_prefix="", decrypt=False):   
-        new_file_name = new_prefix+'temp_file.csv'   
+        new_file_name = new_prefix+'temp_file'+Path(input_filename).suffix # the server reads the file format from the extension
         file_handle = open(input_filename, 'rb')
         file_data = file_handle.read()
         file_handle.close()
@@ -164,18 +183,23 @@ class NLPClient():
             new_f.write(new_data) 
         return new_file_name
         
-    def analyse_file(self, input_filename, txt_col_name="text", limit_rows=0, no_encryption=False): 
+    def analyse_file(self, input_filename, txt_col_name="text", limit_rows=0, no_encryption=False, columns=None, output_format="csv"): 
         start = datetime.datetime.now()
         if not no_encryption:
             input_filename = self.encrypt_decrypt_file(input_filename, new_prefix="encrypted", decrypt=False)
 
         file_to_send=open(input_filename, 'rb') 
-        payload={'txt_col_name': txt_col_name, "amount":limit_rows, "no_encryption":no_encryption}
-        res = requests.post(self.file_stats_url, files={'file': file_to_send}, data=payload)    
+        # csv, jsonl, parquet or arrow files are read by the server from their extension
+        payload={'txt_col_name': txt_col_name, "amount":limit_rows, "no_encryption":no_encryption, "output_format":output_format}
+        if columns is not None:
+            payload["columns"] = columns # only these columns are copied to the result, besides txt_col_name
+        # the server streams the scored rows while it reads the file, they are written as they arrive
+        res = requests.post(self.file_stats_url, files={'file': file_to_send}, data=payload, stream=True)    
         file_to_send.close()
-        output_filename = "stats_"+Path(input_filename).stem+".csv"
+        output_filename = "stats_"+Path(input_filename).stem+"."+output_format
         with open(output_filename, "wb") as f_res:
-            f_res.write(res.content)
+            for block in res.iter_content(chunk_size=1<<20):
+                f_res.write(block)
         if not no_encryption:
             output_filename = self.encrypt_decrypt_file(output_filename, new_prefix="decrypted", decrypt=False)        
         end = datetime.datetime.now()
@@ -9,12 +9,17 @@ sys.path.insert(4, './empathy')
 
 import logging
 import json
+import functools
+import gc
+import time
+import contextvars
+import concurrent.futures
 import numpy as np
 import wget
 import pickle
 import oyaml as yaml
 
-from flask import Flask, request, redirect , jsonify, send_file, send_from_directory, safe_join, abort
+from flask import Flask, request, g, redirect , jsonify, send_file, send_from_directory, safe_join, abort, Response, stream_with_context
 from flask.json import JSONEncoder
 from flask_cors import CORS
 from flask_socketio import SocketIO, send, emit
@@ -30,7 +35,15 @@ from empathy import empathy_processing
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import  FileStorage
 
-from dh_encryption import DiffieHellman, decrypt_data, encrypt_data, decrypt_file, encrypt_file
+from dh_encryption import DiffieHellman, decrypt_data, encrypt_data, decrypt_file, encrypt_file, encrypt_decrypt_chunk, encrypt_decrypt_file_stream
+from file_formats import FileFormats, OUTPUT_FORMATS, OUTPUT_EXTENSIONS, MIMETYPES, get_file_format, get_file_columns, get_file_schema, count_file_rows, read_file_chunks, write_file_chunks, fix_dtypes
+from serialization import dumps, get_request_body, get_response_mimetype, JSON_MIMETYPE, NDJSON_MIMETYPE
+from metrics import REQUEST_LATENCY, REQUESTS, IN_FLIGHT, MODEL_LATENCY, MODEL_BATCH_SIZES, MODEL_TEXTS, CRYPTO_LATENCY, QUEUE_DEPTH, REJECTED, generate_metrics
+from timing import stage, start_timer, stop_timer, start_profiler, stop_profiler
+from inference_workers import InferencePool
+from batching import MicroBatcher
+from admission import AdmissionController
+from jobs import JobStore, JobManager, JobStatus, JobQueueFull
 
 import sys
 import urllib
@@ -60,8 +73,30 @@ class Engine():
         Complexity = "complexity"
         Empathy = "empathy"     
 
-    def register_model(self, model_name, model_fun):
-        self.models_map[model_name] = model_fun
+    def register_model(self, model_name, model_fun, batched=False):
+        # batched models take a list of texts and return a list of dictionaries, one per text
+        # single-text models (a text in, a dictionary out) are wrapped into batched ones
+        if not batched:
+            model_fun = Engine.batch_model(model_fun)
+        self.models_map[model_name] = Engine.measure_model(model_name, model_fun)
+
+    @staticmethod
+    def measure_model(model_name, model_fun):
+        @functools.wraps(model_fun)
+        def measured_model_fun(texts, logger):
+            MODEL_BATCH_SIZES.labels(model_name).observe(len(texts))
+            with MODEL_LATENCY.labels(model_name).time(), stage(model_name):
+                results = model_fun(texts, logger)
+            MODEL_TEXTS.labels(model_name).inc(len(texts))
+            return results
+        return measured_model_fun
+
+    @staticmethod
+    def batch_model(model_fun):
+        @functools.wraps(model_fun)
+        def batched_model_fun(texts, logger):
+            return [model_fun(text, logger) for text in texts]
+        return batched_model_fun
     
     def get_model_methods(self, model_name):
         fun_list = []
@@ -73,6 +108,12 @@ class Engine():
 
     def __init__(self, logger, load_ten_dims=True):
         self.models_map = {}
+        # independent models of a request run concurrently on this pool, None runs them one after another
+        self.models_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MODEL_THREADS, thread_name_prefix="model") if MODEL_THREADS > 0 else None
+        # the worker processes running the models in inference-server mode, see start_inference_workers
+        self.inference_pool = None
+        # the micro-batching schedulers of the models, see start_micro_batching
+        self.batchers = None
         self.ip_keys_dict = {}
         self.using_encryption = True
         self.no_key_error_msg = 'Connection is not secure, request a shared key first'
@@ -95,9 +136,11 @@ class Engine():
             self.embeddings_dir = 'tendims/embeddings'  # change urls to embeddings dir
             self.success_model_file = 'tendims/models/meeting_success/xgboost_10dims_success_prediction_model_v0.81.dat'
             # Success is not available
-            self.model_tendim = TenDimensionsClassifier(models_dir=self.models_dir, embeddings_dir=self.embeddings_dir)
+            self.model_tendim = TenDimensionsClassifier(models_dir=self.models_dir, embeddings_dir=self.embeddings_dir, batch_size=TEN_DIMS_BATCH_SIZE, fused=TEN_DIMS_FUSED, embedding_store=TEN_DIMS_EMBEDDING_STORE, backend=TEN_DIMS_BACKEND, lazy=TEN_DIMS_LAZY)
+            if TEN_DIMS_LAZY and TEN_DIMS_WARMUP:
+                self.model_tendim.warmup(background=True)
             self.success_predictor = SuccessPredictor(self.success_model_file) # Sucess prediction
-            self.register_model(Engine.Models.TenDims, self.get_ten_dims)
+            self.register_model(Engine.Models.TenDims, self.get_ten_dims, batched=True)
             logger.info('Tend dims models loaded')
         #####################
 
@@ -109,12 +152,25 @@ class Engine():
 
         #### Sentiment Models ####
         logger.info('Loading sentiment model...')
-        self.model_sentim = SentimentClassifier()
-        self.register_model(Engine.Models.Sentiment, self.get_sentiment)
+        self.model_sentim = SentimentClassifier(flair_mini_batch_size=FLAIR_MINI_BATCH_SIZE, vader_processes=VADER_PROCESSES, vader_chunk_size=VADER_CHUNK_SIZE)
+        self.register_model(Engine.Models.Sentiment, self.get_sentiment, batched=True)
         logger.info('Sentiment models loaded')
         #####################    
     
 
+    def share_memory(self, logger):
+        """
+        Pre-fork mode: loads every model and moves the large weights and vectors to shared memory,
+        then freezes the garbage collector, so that the loaded objects are never scanned (and copied) by the forked workers
+        """
+        logger.info('Moving the models to shared memory...')
+        if hasattr(self, "model_tendim"):
+            self.model_tendim.share_memory()
+        self.model_sentim.share_memory()
+        gc.collect()
+        gc.freeze()
+        logger.info(f'Models shared, {gc.get_freeze_count()} objects frozen')
+
     def generate_keys(self, ip_address, logger):        
         self.ip_keys_dict[ip_address] = {}
         client_private_key, client_public_key = self.dh.get_private_key(), self.dh.gen_public_key()
@@ -147,17 +203,12 @@ class Engine():
         if code >= 400:
             return code, error_text        
         try:
-            with open(os.path.join(folder, filename), 'rb') as enc_file:
-                file_data = enc_file.read()
             if self.using_encryption:
-                temp_filename = new_prefix+'_temp_file_data.csv'
+                temp_filename = new_prefix+'_'+uuid.uuid4().hex+'_temp_file_data'+os.path.splitext(filename)[1] # the extension gives the file format
                 client_shared_key = self.ip_keys_dict[ip_address]["client"]["shared_key"]  
-                if decrypt:
-                    new_data = decrypt_file(file_data, client_shared_key)
-                else:
-                    new_data = encrypt_file(file_data, client_shared_key)
-                with open(os.path.join(folder, temp_filename), 'wb') as dec_file:
-                    dec_file.write(new_data) 
+                # XOR is symmetric, decrypting and encrypting are the same operation
+                with CRYPTO_LATENCY.labels("decrypt" if decrypt else "encrypt").time():
+                    encrypt_decrypt_file_stream(os.path.join(folder, filename), os.path.join(folder, temp_filename), client_shared_key)
                 try:
                     os.remove(os.path.join(folder, filename))    
                 except:
@@ -182,7 +233,8 @@ class Engine():
         try:
             if engine.using_encryption:
                 client_shared_key = engine.ip_keys_dict[ip_address]["client"]["shared_key"] 
-                text = decrypt_data(text, client_shared_key)
+                with CRYPTO_LATENCY.labels("decrypt").time(), stage("decrypt"):
+                    text = decrypt_data(text, client_shared_key)
                 logger.debug(f"\n\n{method}: Received encrypted Text, decrypted using {ip_address} key {client_shared_key}: {text}")
             else:
                 logger.debug(f"\n\n{method}: Received plain Text from {ip_address}: {text}")
@@ -192,20 +244,25 @@ class Engine():
             logger.error(error_text)
             return 400, error_text
 
-    def get_ten_dims(self, text, logger):  
+    def get_ten_dims(self, texts, logger):  
+        tendim_scores_list = []
         if USE_TEN_DIMS:
-            # you can give in input one string of text
+            # the whole list of texts is scored in padded mini-batches
             # dimensions = None extracts all dimensions
-            tendim_scores = engine.model_tendim.compute_score(text, dimensions=None)
-            success_probability = engine.success_predictor.predict_success(tendim_scores)
-            tendim_scores['success'] = float(success_probability)
+            for tendim_scores in engine.model_tendim.compute_score_batch(texts, dimensions=None):
+                success_probability = engine.success_predictor.predict_success(tendim_scores)
+                tendim_scores['success'] = float(success_probability)
+                tendim_scores_list.append(tendim_scores)
         else:        
-            tendim_scores = {'conflict': 0, 'fun': 0, 'identity': 0, 'knowledge': 0, 'power': 0, 'romance': 0, 'similarity': 0, 'status': 0, 'support': 0, 'trust': 0}
-            tendim_scores['success'] = 0
-        return tendim_scores
+            for _ in texts:
+                tendim_scores = {'conflict': 0, 'fun': 0, 'identity': 0, 'knowledge': 0, 'power': 0, 'romance': 0, 'similarity': 0, 'status': 0, 'support': 0, 'trust': 0}
+                tendim_scores['success'] = 0
+                tendim_scores_list.append(tendim_scores)
+        return tendim_scores_list
         
-    def get_sentiment(self, text, logger):  
-        return self.model_sentim.get_sentiment(text)
+    def get_sentiment(self, texts, logger):  
+        # with the VADER workers, iter_stats scores VADER on the whole request at once
+        return self.model_sentim.get_sentiment_list(texts, vader=self.model_sentim.vader_pool is None)
     
     def get_complexity(self, text, logger):  
         return self.model_complexity.get_complexity(text)
@@ -214,18 +271,117 @@ class Engine():
         avg_empathy, avg_ic, scored_text_list = engine.empathy_scorer.empathyIC_from_texts(text)
         return {'Average_Empathy': avg_empathy , 'Average_IC':avg_ic}
 
+    def group_models(self, stat_method):
+        # the models listed together in model_thread_groups run one after another on the same thread,
+        # every other model gets its own thread
+        groups = []
+        for group_names in MODEL_THREAD_GROUPS:
+            group = [self.models_map[name] for name in group_names if name in self.models_map and self.models_map[name] in stat_method]
+            if group:
+                groups.append(group)
+        grouped = [stat_fun for group in groups for stat_fun in group]
+        groups.extend([[stat_fun] for stat_fun in stat_method if stat_fun not in grouped])
+        return groups
+
+    def run_model_group(self, group, texts, logger):
+        return {stat_fun: stat_fun(texts, logger) for stat_fun in group}
+
+    def run_queued_model_group(self, group, texts, logger):
+        try:
+            return self.run_model_group(group, texts, logger)
+        finally:
+            QUEUE_DEPTH.labels("models").dec()
+
+    def start_inference_workers(self, workers, torch_threads, pin_cpus, logger):
+        # from now on the models run in the worker processes, forked with the models loaded by the first process using them
+        self.inference_pool = InferencePool(self.models_map, workers, torch_threads=torch_threads, pin_cpus=pin_cpus, logger=logger)
+
+    def run_models_in_workers(self, stat_method, texts, logger):
+        fun2name = {stat_fun: name for name, stat_fun in self.models_map.items()}
+        groups = [[fun2name[stat_fun] for stat_fun in group] for group in self.group_models(stat_method)]
+        QUEUE_DEPTH.labels("inference").inc(len(groups))
+        futures = []
+        for group in groups:
+            future = self.inference_pool.submit(group, texts)
+            future.add_done_callback(lambda _: QUEUE_DEPTH.labels("inference").dec())
+            futures.append(future)
+        results = {}
+        for group, future in zip(groups, futures):
+            with stage("+".join(group)):
+                for name, result in future.result().items():
+                    results[self.models_map[name]] = result
+        return results
+
+    def start_micro_batching(self, max_batch_size, max_wait, logger):
+        # every model gets a scheduler batching the texts of the concurrent requests, see run_models
+        dispatchers = self.inference_pool.workers if self.inference_pool is not None else 1
+        self.batchers = {stat_fun: MicroBatcher(functools.partial(self.run_single_model, name, stat_fun, logger), max_batch_size=max_batch_size, max_wait=max_wait,
+                                                dispatchers=dispatchers, name=f"batcher-{name}", queue_gauge=QUEUE_DEPTH.labels("micro_batch"))
+                         for name, stat_fun in self.models_map.items()}
+
+    def run_single_model(self, name, stat_fun, logger, texts):
+        if self.inference_pool is not None:
+            return self.inference_pool.submit([name], texts).result()[name]
+        return stat_fun(texts, logger)
+
+    def run_models_in_batches(self, stat_method, texts, logger):
+        # the models of the request are queued at the same time, each with its own scheduler
+        futures = {stat_fun: self.batchers[stat_fun].submit(texts) for stat_fun in stat_method}
+        results = {}
+        for stat_fun, future in futures.items():
+            with stage(self.batchers[stat_fun].name):
+                results[stat_fun] = future.result()
+        return results
+
+    def run_models(self, stat_method, texts, logger):
+        results = {}
+        if self.batchers is not None:
+            results = self.run_models_in_batches(stat_method, texts, logger)
+        elif self.inference_pool is not None:
+            results = self.run_models_in_workers(stat_method, texts, logger)
+        elif self.models_executor is None or len(stat_method) <= 1:
+            results = self.run_model_group(stat_method, texts, logger)
+        else:
+            groups = self.group_models(stat_method)
+            QUEUE_DEPTH.labels("models").inc(len(groups))
+            # each thread runs in a copy of the request context, so that the stages of its models are timed
+            futures = [self.models_executor.submit(contextvars.copy_context().run, self.run_queued_model_group, group, texts, logger) for group in groups]
+            for future in futures:
+                results.update(future.result())
+        return results
+
     def calculate_stats(self, texts, text_ids, stat_method, logger):
+        returnAll = []
+        for chunk_data in self.iter_stats(texts, text_ids, stat_method, logger):
+            returnAll.extend(chunk_data)
+        return returnAll        
+
+    def iter_stats(self, texts, text_ids, stat_method, logger):
+        """
+        Scores the texts in chunks of MODEL_BATCH_SIZE
+        @return a generator of the list of results of each chunk, as soon as it is scored
+        """
         if not isinstance(stat_method, list):
             stat_method = [stat_method]
-        returnAll = []
-        for txt, txt_id in zip(texts,text_ids):
-            return_data = {}
-            return_data["server_text_id"] = txt_id
+        texts_and_ids = list(zip(texts, text_ids))
+        vader_scores = None
+        if self.models_map.get(Engine.Models.Sentiment) in stat_method and self.model_sentim.vader_pool is not None:
+            # all the chunks of VADER are queued to its workers now, they run while the chunks of the other models are scored
+            vader_scores = self.model_sentim.submit_vader_sentiment_list(list(texts))
+        # model-major: each model is called once per chunk of texts, then the results are merged per text
+        for start in range(0, len(texts_and_ids), MODEL_BATCH_SIZE):
+            chunk_texts = [txt for txt, _ in texts_and_ids[start:start+MODEL_BATCH_SIZE]]
+            chunk_data = [{"server_text_id": txt_id} for _, txt_id in texts_and_ids[start:start+MODEL_BATCH_SIZE]]
             # return_data["server_text_data"] = str(txt)
+            results = self.run_models(stat_method, chunk_texts, logger)
             for stat_fun in stat_method:
-                return_data.update(stat_fun(txt, logger))
-            returnAll.append(return_data)
-        return returnAll        
+                for return_data, result in zip(chunk_data, results[stat_fun]):
+                    return_data.update(result)
+            if vader_scores is not None:
+                with stage("vader"):
+                    for return_data in chunk_data:
+                        return_data["vader"] = next(vader_scores)
+            yield chunk_data
 
     def call_model_from_text(self, ip_address, text, no_encryption, method, logger):
         try:
@@ -249,23 +405,47 @@ class Engine():
             logger.error(f"Exception in Text {method}:{e}")
             return {"message": f"Internal Server Error in Text {method}", "error_info":str(e), "status": 500}, 500
 
-    def call_model_from_request(self, flask_request, method, logger):
-        try:   
-            text = flask_request.form.getlist('text')
-            if len(text) <= 0:
-                text = [flask_request.form.get('text')]
-
-            no_encryption = flask_request.form.get('no_encryption', False)
+    def get_request_texts(self, flask_request, method, logger):
+        # the texts come in a JSON or msgpack body or in the form
+        with stage("parse"):
+            code, body = get_request_body(flask_request)
+        if code >= 400:
+            logger.error(body)
+            return code, body, [], False
+        if body is not None:
+            text = body.get('text')
+            text = text if isinstance(text, list) else [text]
+            text_id = body.get('id')
+            text_id = text_id if isinstance(text_id, list) else [text_id]
+            no_encryption = body.get('no_encryption', False)
             retCode = 200
             if not no_encryption:
-                retCode, text = engine.get_decrypted_text(flask_request.remote_addr, text, method, logger)   
+                retCode, text = engine.get_decrypted_text(flask_request.remote_addr, text, method, logger)
+            return retCode, text, text_id, no_encryption
+
+        text = flask_request.form.getlist('text')
+        if len(text) <= 0:
+            text = [flask_request.form.get('text')]
+
+        no_encryption = flask_request.form.get('no_encryption', False)
+        retCode = 200
+        if not no_encryption:
+            retCode, text = engine.get_decrypted_text(flask_request.remote_addr, text, method, logger)   
 
-            text_id = flask_request.form.getlist('id')
-            if len(text_id) <= 0:
-                text_id = [flask_request.form.get('id')]
+        text_id = flask_request.form.getlist('id')
+        if len(text_id) <= 0:
+            text_id = [flask_request.form.get('id')]
+        return retCode, text, text_id, no_encryption
+
+    def call_model_from_request(self, flask_request, method, logger, stream=False):
+        # with stream the results are a generator of the scored chunks, see iter_stats
+        try:   
+            retCode, text, text_id, no_encryption = self.get_request_texts(flask_request, method, logger)
 
             logger.info(f"Text stats request from {flask_request.remote_addr}. Encrypted: {not no_encryption}. List len: {len(text)}") 
             if retCode == 200:
+                if stream:
+                    return engine.iter_stats(text, text_id, self.get_model_methods(method), logger), retCode
                 ret = engine.calculate_stats(text, text_id, self.get_model_methods(method), logger)
                 return ret, retCode
             else:
@@ -279,6 +459,27 @@ class Engine():
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS 
 
+def receive_request_file(flask_request, logger):
+    """
+    Saves the uploaded file of the request in the UPLOAD_FOLDER and decrypts it
+    @return code, the name of the saved file (or the error message) and whether the file was sent without encryption
+    """
+    no_encryption = str(flask_request.form.get('no_encryption')) != "False" # No clue why the boolean is returned as a string... But just in case I converted it to a string every time
+    # check if the post request has the file part
+    if 'file' not in flask_request.files or flask_request.files['file'].filename == '':
+        return 400, "No file submitted", no_encryption
+    file = flask_request.files['file']
+    if not allowed_file(file.filename):
+        return 400, f"File type not allowed, use one of {ALLOWED_EXTENSIONS}", no_encryption
+    filename = secure_filename(file.filename)                
+    if not os.path.exists(UPLOAD_FOLDER):
+        os.makedirs(UPLOAD_FOLDER)
+    file.save(os.path.join(UPLOAD_FOLDER, filename))
+    code = 200
+    if not no_encryption:
+        code, filename = engine.encrypt_decrypt_file(flask_request.remote_addr, UPLOAD_FOLDER, filename, logger, new_prefix="decrypted", decrypt=True)
+    return code, filename, no_encryption
+
 parser = ArgumentParser()
 parser.add_argument('-c', nargs='?', const="config.yaml", type=str)
 args = parser.parse_args()
@@ -291,22 +492,143 @@ except:
     config = {}
 
 UPLOAD_FOLDER = config.get("upload_folder", './uploaded_files/')
-ALLOWED_EXTENSIONS = config.get("allowed_extensions", {'csv', 'txt', 'dat', 'json'})
+ALLOWED_EXTENSIONS = config.get("allowed_extensions", {'csv', 'txt', 'dat', 'json', 'jsonl', 'ndjson', 'parquet', 'arrow', 'feather'})
 IP = config.get("ip", "0.0.0.0")
 PORT = config.get("port", 5000)
 USE_TEN_DIMS = config.get("use_ten_dims", True)
+TEN_DIMS_BATCH_SIZE = config.get("ten_dims_batch_size", 64)
+TEN_DIMS_FUSED = config.get("ten_dims_fused", False)
+TEN_DIMS_EMBEDDING_STORE = config.get("ten_dims_embedding_store", "store")
+TEN_DIMS_BACKEND = config.get("ten_dims_backend", "eager")
+TEN_DIMS_LAZY = config.get("ten_dims_lazy", False)
+TEN_DIMS_WARMUP = config.get("ten_dims_warmup", False)
+FLAIR_MINI_BATCH_SIZE = config.get("flair_mini_batch_size", 32)
+VADER_PROCESSES = config.get("vader_processes", 0)
+VADER_CHUNK_SIZE = config.get("vader_chunk_size", 128)
+MODEL_BATCH_SIZE = config.get("model_batch_size", 256)
+MODEL_THREADS = config.get("model_threads", 0)
+MODEL_THREAD_GROUPS = config.get("model_thread_groups", [])
+FILE_CHUNK_SIZE = config.get("file_chunk_size", 1000)
+JOB_WORKERS = config.get("job_workers", 2)
+JOB_CHUNK_SIZE = config.get("job_chunk_size", 256)
+MAX_PENDING_JOBS = config.get("max_pending_jobs", 100)
+JOBS_DB = config.get("jobs_db", None)
+JOB_TTL = config.get("job_ttl", 24*3600)
+SERVER_TIMING = config.get("server_timing", False)
+PREFORK_SHARE = config.get("prefork_share", False)
+INFERENCE_WORKERS = config.get("inference_workers", 0)
+INFERENCE_TORCH_THREADS = config.get("inference_torch_threads", 1)
+INFERENCE_PIN_CPUS = config.get("inference_pin_cpus", False)
+MICRO_BATCH_SIZE = config.get("micro_batch_size", 0)
+MICRO_BATCH_WAIT_MS = config.get("micro_batch_wait_ms", 10)
+MAX_CONCURRENT_REQUESTS = config.get("max_concurrent_requests", 0)
+MAX_PENDING_REQUESTS = config.get("max_pending_requests", 100)
+MAX_REQUESTS_PER_CLIENT = config.get("max_requests_per_client", 0)
+MAX_QUEUE_WAIT = config.get("max_queue_wait", 30)
+RETRY_AFTER = config.get("retry_after", 1)
 LOG_FILENAME = config.get("log_filename", "flask_log.log")
 
 app = Flask(__name__)
-with open(LOG_FILENAME, 'w'):
-    pass
-handler = logging.FileHandler(LOG_FILENAME)  # Create the file logger
-app.logger.addHandler(handler)             # Add it to the built-in logger
-app.logger.setLevel(logging.DEBUG)         # Set the log level to debug
 app.json_encoder = CustomJSONEncoder
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 socketio = SocketIO(app)
-engine = Engine(app.logger, USE_TEN_DIMS)
+
+def score_job_chunk(texts, text_ids, method):
+    return engine.calculate_stats(texts, text_ids, engine.get_model_methods(method), app.logger)
+
+# the spawned workers of the VADER pool (vader_processes) re-run the main script as __mp_main__. Started with run_server.py
+# they never import this module, started as python nlp_flask_server.py they import it again (with torch and flair):
+# at least they must not truncate the log, load the models or start the pools of the server again
+if __name__ != '__mp_main__':
+    with open(LOG_FILENAME, 'w'):
+        pass
+    handler = logging.FileHandler(LOG_FILENAME)  # Create the file logger
+    app.logger.addHandler(handler)             # Add it to the built-in logger
+    app.logger.setLevel(logging.DEBUG)         # Set the log level to debug
+    engine = Engine(app.logger, USE_TEN_DIMS)
+    if PREFORK_SHARE:
+        engine.share_memory(app.logger)
+    if INFERENCE_WORKERS > 0:
+        engine.start_inference_workers(INFERENCE_WORKERS, INFERENCE_TORCH_THREADS, INFERENCE_PIN_CPUS, app.logger)
+    if MICRO_BATCH_SIZE > 0:
+        engine.start_micro_batching(MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_MS / 1000, app.logger)
+    job_manager = JobManager(score_job_chunk, JobStore(JOBS_DB, json_encoder=CustomJSONEncoder, ttl=JOB_TTL), workers=JOB_WORKERS, chunk_size=JOB_CHUNK_SIZE, max_pending_jobs=MAX_PENDING_JOBS, logger=app.logger, queue_gauge=QUEUE_DEPTH.labels("jobs"))
+
+def start_workers():
+    """
+    Starts the inference worker processes and the job threads of the server in the process serving the requests.
+    gunicorn calls it in each worker (see gunicorn_conf.py), before the worker starts its threads: the workers are forked first
+    """
+    if engine.inference_pool is not None:
+        engine.inference_pool.get_executor()
+    job_manager.start()
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    IN_FLIGHT.inc()
+    # the stage timings (and the profiler) only run when asked for, stage() is a no-op otherwise
+    profile = request.args.get("profile") == "1"
+    if SERVER_TIMING or profile:
+        g.timer = start_timer()
+    if profile:
+        g.profiler = start_profiler()
+
+# the scoring endpoints go through the admission control, keyed by the client address as the encryption keys
+admission = AdmissionController(MAX_CONCURRENT_REQUESTS, MAX_PENDING_REQUESTS, MAX_REQUESTS_PER_CLIENT, MAX_QUEUE_WAIT,
+                                pending_gauge=QUEUE_DEPTH.labels("admission_pending"), in_flight_gauge=QUEUE_DEPTH.labels("admission_in_flight"))
+ADMISSION_ENDPOINTS = {"getStats", "getStatsFile", "tenDimensions", "complexity", "sentiment", "empathy"}
+
+@app.before_request
+def admit_request():
+    if request.endpoint not in ADMISSION_ENDPOINTS or (MAX_CONCURRENT_REQUESTS <= 0 and MAX_REQUESTS_PER_CLIENT <= 0):
+        return None
+    rejection = admission.admit(request.remote_addr)
+    if rejection is not None:
+        REJECTED.labels(rejection).inc()
+        app.logger.info(f"Rejected request to {request.endpoint} from {request.remote_addr}: {rejection}")
+        response = jsonify({"message": "Too many requests, retry later", "error_info": rejection, "status": 429})
+        response.status_code = 429
+        response.headers["Retry-After"] = str(RETRY_AFTER)
+        return response
+    g.admitted = True
+    return None
+
+@app.after_request
+def release_request(response):
+    if g.get("admitted", False):
+        client = request.remote_addr
+        # on close, the streamed responses are still scoring
+        response.call_on_close(lambda: admission.release(client))
+        g.admitted = False
+    return response
+
+@app.after_request
+def end_request_metrics(response):
+    endpoint = request.endpoint or "unknown"
+    start = g.get("request_start", None)
+    if g.get("profiler", None) is not None:
+        stop_profiler(g.pop("profiler"))
+    if g.get("timer", None) is not None:
+        response.headers["Server-Timing"] = g.timer.server_timing()
+        stop_timer()
+
+    def observe():
+        # on close, so that the streamed responses count until their last byte
+        IN_FLIGHT.dec()
+        REQUESTS.labels(endpoint, str(response.status_code)).inc()
+        if start is not None:
+            REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - start)
+
+    response.call_on_close(observe)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    data, content_type = generate_metrics()
+    if data is None:
+        return jsonify({"message": "Metrics not available", "error_info": "prometheus_client is not installed", "status": 501}), 501
+    return Response(data, content_type=content_type)
 
 
 @app.route("/request-keys", methods=["GET"])
@@ -341,83 +663,224 @@ def request_shared_key():
         return jsonify({"message": f"Internal Server Error in {method}", "error_info":str(e), "status": 500}), 500
     
 
+def wants_stream():
+    return get_response_mimetype(request) == NDJSON_MIMETYPE
+
+def stats_response(ret_data, code):
+    # JSON, msgpack or NDJSON, as asked by the Accept header of the request
+    mimetype = get_response_mimetype(request)
+    if mimetype != NDJSON_MIMETYPE:
+        if g.get("profiler", None) is not None and mimetype == JSON_MIMETYPE:
+            ret_data = {"results": ret_data, "profile": {"stages_ms": g.timer.get_stages_ms(), "cprofile": stop_profiler(g.pop("profiler"))}}
+        with stage("serialize"):
+            body = dumps(ret_data, mimetype)
+        return Response(body, status=code, mimetype=mimetype)
+    if code != 200 or isinstance(ret_data, (list, dict)):
+        return Response(dumps(ret_data), status=code, mimetype=JSON_MIMETYPE)
+
+    def generate():
+        # one line per text, each chunk is sent as soon as it is scored
+        try:
+            for chunk_data in ret_data:
+                yield b''.join(dumps(return_data) + b'\n' for return_data in chunk_data)
+        except Exception as e:
+            app.logger.error(f"Exception in stats stream:{e}")
+            # the headers are already sent: raising aborts the chunked response, so the client cannot take it for a complete one
+            raise
+
+    return Response(stream_with_context(generate()), status=code, mimetype=NDJSON_MIMETYPE)
+
 @app.route("/getStats", methods=['POST'])
 def getStats():
-    ret_data, code = engine.call_model_from_request(request, Engine.Models.All, app.logger)
-    return jsonify(ret_data), code
+    ret_data, code = engine.call_model_from_request(request, Engine.Models.All, app.logger, stream=wants_stream())
+    return stats_response(ret_data, code)
+
+def stream_file_stats(file_path, file_format, txt_col, usecols, amount, logger, fixed_dtypes=False):
+    """
+    Reads the file in chunks of FILE_CHUNK_SIZE rows, scores each chunk in one batch
+    and yields the scored chunks, all with the columns of the first one
+    @param fixed_dtypes: to give every column the same dtype in all the chunks (see fix_dtypes), for the Parquet output
+    """
+    columns = None
+    processed = 0
+    for chunk_df in read_file_chunks(file_path, file_format, usecols=usecols, chunk_size=FILE_CHUNK_SIZE):
+        if amount > 0:
+            chunk_df = chunk_df.iloc[:amount - processed].copy()
+        chunk_df.index = range(processed, processed + len(chunk_df))
+        chunk_df["idx"] = chunk_df.index
+        ret_data = engine.calculate_stats(chunk_df[txt_col].astype(str).tolist(), chunk_df["idx"].tolist(), engine.get_model_methods(Engine.Models.All), logger)
+        scores_df = pd.DataFrame(ret_data, index=chunk_df.index)
+        if fixed_dtypes:
+            # csv and jsonl have no column types, their columns are strings. The columns of the columnar formats get the schema of the file (see write_file_chunks)
+            if file_format in [FileFormats.Csv, FileFormats.Jsonl]:
+                chunk_df = fix_dtypes(chunk_df, string_cols=[col for col in chunk_df.columns if col != "idx"])
+            scores_df = fix_dtypes(scores_df, float_cols=[col for col in scores_df.columns if col != "server_text_id"])
+        chunk_df = pd.concat([chunk_df, scores_df], axis=1)
+        if columns is None:
+            columns = list(chunk_df.columns)
+        yield chunk_df.reindex(columns=columns)
+        processed += len(chunk_df)
+        if amount > 0 and processed >= amount:
+            break
 
 @app.route("/getStatsFile", methods=['POST'])
 def getStatsFile():
-    no_encryption = str(request.form.get('no_encryption')) != "False" # No clue why the boolean is returned as a string... But just in case I converted it to a string every time
-    # check if the post request has the file part
-    if 'file' not in request.files:
-        return jsonify({"message": f"No file submitted", "error_info":f"No file submitted", "status": 400}), 400
-    file = request.files['file']
     # If the user does not select a file, the browser submits an empty file without a filename.
-    if file.filename == '':
+    if 'file' in request.files and request.files['file'].filename == '':
         return redirect(request.url)
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)                
-        if not os.path.exists(UPLOAD_FOLDER):
-            os.makedirs(UPLOAD_FOLDER)
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        if not no_encryption:
-            code, filename = engine.encrypt_decrypt_file(request.remote_addr, UPLOAD_FOLDER, filename, app.logger, new_prefix="decrypted", decrypt=True)
-    
-    txt_col = request.form["txt_col_name"]    
-        
+    code, filename, no_encryption = receive_request_file(request, app.logger)
+    if code >= 400:
+        return jsonify({"message": filename, "error_info": filename, "status": code}), code
+    file_path = os.path.join(UPLOAD_FOLDER, filename)
+
+    def remove_file():
+        try:
+            os.remove(file_path)
+        except:
+            print(f"Error removing file {filename}")
+
+    txt_col = request.form["txt_col_name"]
+    output_format = request.form.get("output_format", FileFormats.Csv)
+    if output_format not in OUTPUT_FORMATS:
+        remove_file()
+        return jsonify({"message": f"Unsupported output format", "error_info":f"Unsupported output format {output_format}, use one of {OUTPUT_FORMATS}", "status": 400}), 400
+    # the passthrough columns copied to the output, all of them by default
+    passthrough_cols = request.form.getlist("columns")
     amount = int(request.form.get("amount", 0))   
-    data_df = pd.read_csv(os.path.join(app.config['UPLOAD_FOLDER'], filename)) 
     try:
-        os.remove(os.path.join(app.config['UPLOAD_FOLDER'], filename))    
-    except:
-        print(f"Error removing file {filename}")
-    # remove file
-    data_df["idx"] = range(0,len(data_df))
-    app.logger.info(f"File stats request from {request.remote_addr}. Encrypted: {not no_encryption}. Row col: {txt_col}, limit: {amount}, rows: {len(data_df)}") 
-    output_filename = os.path.splitext(filename)[0]
-    output_filename = UPLOAD_FOLDER+output_filename+"_pandas_res.csv"
-    initialized = False
-    for index, row in data_df.iterrows():
-        ret_data, code = engine.call_model_from_text(request.remote_addr, str(row[txt_col]), True, Engine.Models.All, app.logger)
-        if code == 200 :
-            for key, value in ret_data[0].items():
-                if not initialized:
-                    data_df[key] = 0 if type(value) == int or float else ""
-                    initialized = True
-                data_df.at[index, key] = value
-        else:
-            app.logger.error(f"{ret_data}\t{index}\t{row[txt_col]}")
-        if amount > 0 and index >= amount:
-            break
-    data_df.to_csv(output_filename)
-    if not no_encryption:
-        code, output_filename = engine.encrypt_decrypt_file(request.remote_addr, UPLOAD_FOLDER, output_filename, app.logger, new_prefix="encrypted", decrypt=False)
+        file_format = request.form.get("file_format", get_file_format(filename))
+        file_cols = get_file_columns(file_path, file_format)
+    except Exception as e:
+        remove_file()
+        return jsonify({"message": f"Could not read the file", "error_info":str(e), "status": 400}), 400
+    missing_cols = [col for col in [txt_col] + passthrough_cols if col not in file_cols]
+    if missing_cols:
+        remove_file()
+        return jsonify({"message": f"Columns not found in the file", "error_info":f"Columns not found in the file: {missing_cols}", "status": 400}), 400
+    usecols = None if len(passthrough_cols) <= 0 else [col for col in file_cols if col == txt_col or col in passthrough_cols]
+    client_shared_key = None if no_encryption or not engine.using_encryption else engine.ip_keys_dict[request.remote_addr]["client"]["shared_key"]
+    app.logger.info(f"File stats request from {request.remote_addr}. Encrypted: {not no_encryption}. Row col: {txt_col}, limit: {amount}, columns: {usecols}, format: {file_format} -> {output_format}") 
+
+    def generate():
+        # the rows are sent as soon as their chunk is scored, encrypted at their offset in the response
+        offset = 0
+        try:
+            # the Parquet output of a columnar file keeps the column types of the file, not the ones of the first chunk
+            schema = get_file_schema(file_path, file_format, usecols) if output_format == FileFormats.Parquet and file_format in [FileFormats.Parquet, FileFormats.Arrow] else None
+            for data in write_file_chunks(stream_file_stats(file_path, file_format, txt_col, usecols, amount, app.logger, fixed_dtypes=output_format == FileFormats.Parquet), output_format, schema=schema):
+                if client_shared_key is not None:
+                    with CRYPTO_LATENCY.labels("encrypt").time():
+                        data = encrypt_decrypt_chunk(data, client_shared_key, offset)
+                offset += len(data)
+                yield data
+        except Exception as e:
+            app.logger.error(f"Exception in files stats:{e}")
+            # the headers are already sent: raising aborts the chunked response, so the client gets an error instead of a truncated file
+            raise
+        finally:
+            remove_file()
+
+    output_filename = os.path.splitext(filename)[0]+"_pandas_res."+OUTPUT_EXTENSIONS[output_format]
+    return Response(stream_with_context(generate()), mimetype=MIMETYPES[output_format], headers={"Content-Disposition": f"attachment; filename={output_filename}"})
+
+@app.route("/jobs", methods=['POST'])
+def create_job():
+    code, body = get_request_body(request)
+    method = (body if isinstance(body, dict) else request.form).get("model", Engine.Models.All)
+    if method != Engine.Models.All and method not in engine.models_map:
+        return jsonify({"message": f"Unknown model {method}", "error_info": f"Available models: {list(engine.models_map.keys())}", "status": 400}), 400
     try:
-        return send_file(output_filename, attachment_filename=output_filename+"_pandas_res.csv")
+        if 'file' in request.files:
+            code, filename, no_encryption = receive_request_file(request, app.logger)
+            if code >= 400:
+                return jsonify({"message": filename, "error_info": filename, "status": code}), code
+            txt_col = request.form["txt_col_name"]
+            file_path = os.path.join(UPLOAD_FOLDER, filename)
+            submitted = False
+            try:
+                file_format = request.form.get("file_format", get_file_format(filename))
+                if txt_col not in get_file_columns(file_path, file_format):
+                    return jsonify({"message": f"Columns not found in the file", "error_info":f"Columns not found in the file: {[txt_col]}", "status": 400}), 400
+                # the file stays on disk, the job reads it chunk by chunk and removes it when it ends
+                job = job_manager.submit_file(file_path, file_format, txt_col, count_file_rows(file_path, file_format, txt_col), method, request.remote_addr)
+                submitted = True
+            finally:
+                if not submitted:
+                    try:
+                        os.remove(file_path)
+                    except:
+                        print(f"Error removing file {filename}")
+        else:
+            code, texts, text_ids, no_encryption = engine.get_request_texts(request, method, app.logger)
+            if code >= 400:
+                return jsonify({"message": f"Something went wrong while reading the job texts. Code: {code}", "error_info": texts, "status": code}), code
+            if len(text_ids) != len(texts) or None in text_ids:
+                text_ids = list(range(len(texts)))
+            job = job_manager.submit(texts, text_ids, method, request.remote_addr)
+    except JobQueueFull as e:
+        return jsonify({"message": "Too many pending jobs", "error_info": str(e), "status": 503}), 503
     except Exception as e:
-        app.logger.error(f"Exception in files stats:{e}")
-        return jsonify({"message": f"Internal Server Error in files stats", "error_info":str(e), "status": 500}), 500
+        app.logger.error(f"Exception in create job:{e}")
+        return jsonify({"message": f"Internal Server Error in create job", "error_info":str(e), "status": 500}), 500
+    app.logger.info(f"Job {job['job_id']} from {request.remote_addr}. Encrypted: {not no_encryption}. Model: {method}, texts: {job['total']}")
+    job["status_code"] = 202
+    return jsonify(job), 202
+
+def get_request_job(job_id):
+    # like the encryption keys, a job belongs to the address that submitted it
+    job_manager.start()
+    job = job_manager.store.get(job_id)
+    if job is None or job["owner"] != request.remote_addr:
+        return None
+    return job
+
+@app.route("/jobs/<job_id>", methods=['GET'])
+def job_status(job_id):
+    job = get_request_job(job_id)
+    if job is None:
+        return jsonify({"message": f"Job {job_id} not found", "error_info": f"Job {job_id} not found", "status": 404}), 404
+    job["progress"] = job["processed"] / job["total"] if job["total"] > 0 else 1.0
+    job["status_code"] = 200
+    return jsonify(job), 200
+
+@app.route("/jobs/<job_id>/result", methods=['GET'])
+def job_result(job_id):
+    """
+    The results of a finished (or failed) job. With partial=True the results computed so far while the job is running.
+    start skips the results already downloaded
+    """
+    job = get_request_job(job_id)
+    if job is None:
+        return jsonify({"message": f"Job {job_id} not found", "error_info": f"Job {job_id} not found", "status": 404}), 404
+    partial = str(request.args.get("partial", False)) not in ["False", "false", "0"]
+    if job["status"] in [JobStatus.Queued, JobStatus.Running] and not partial:
+        job["status_code"] = 202
+        return jsonify(job), 202
+    start = int(request.args.get("start", 0))
+    job["results"] = job_manager.store.get_results(job_id, start)
+    job["start"] = start
+    job["status_code"] = 200
+    return stats_response(job, 200)
 
 @app.route("/tenDimensions", methods=['POST'])
 def tenDimensions():
-    ret_data, code = engine.call_model_from_request(request, Engine.Models.TenDims, app.logger)
-    return jsonify(ret_data), code
+    ret_data, code = engine.call_model_from_request(request, Engine.Models.TenDims, app.logger, stream=wants_stream())
+    return stats_response(ret_data, code)
             
 @app.route("/complexity", methods=['POST'])
 def complexity():
-    ret_data, code = engine.call_model_from_request(request, Engine.Models.Complexity, app.logger)
-    return jsonify(ret_data), code
+    ret_data, code = engine.call_model_from_request(request, Engine.Models.Complexity, app.logger, stream=wants_stream())
+    return stats_response(ret_data, code)
 
 @app.route("/sentiment", methods=['POST'])
 def sentiment():
-    ret_data, code = engine.call_model_from_request(request, Engine.Models.Sentiment, app.logger)
-    return jsonify(ret_data), code
+    ret_data, code = engine.call_model_from_request(request, Engine.Models.Sentiment, app.logger, stream=wants_stream())
+    return stats_response(ret_data, code)
         
 @app.route("/empathy", methods=['GET'])
 def empathy():
-    ret_data, code = engine.call_model_from_request(request, Engine.Models.Sentiment, app.logger)
-    return jsonify(ret_data), code
+    ret_data, code = engine.call_model_from_request(request, Engine.Models.Sentiment, app.logger, stream=wants_stream())
+    return stats_response(ret_data, code)
 
 @socketio.on('json')
 def handle_json(json):
@@ -430,12 +893,16 @@ def handle_message(message):
     app.logger.info('received message: ' + str(message))
     send(message)
 
-if __name__ == '__main__':
+def main():
     CORS(app)
+    start_workers()
     app.run(host="0.0.0.0",port=5000,threaded=True)
     socketio.run(app)
     app.run()
 
+if __name__ == '__main__':
+    main()
+
 # Run gunicorn
 # sudo nohup sudo gunicorn3 --workers 30 --timeout 0 --bind 0.0.0.0:5000 wsgi:app &
 # sudo nohup sudo gunicorn3 --threads 100 --timeout 0 --bind 0.0.0.0:5000 wsgi:app &
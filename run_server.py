@@ -0,0 +1,6 @@
+# Starts the server with python: sudo python run_server.py -c config5000.yaml
+# The server is only imported when this is the main script: the spawned VADER workers (vader_processes) run this script
+# again as __mp_main__, and so they only import sentiment/scorer_pool.py and vaderSentiment, not torch, flair and the models
+if __name__ == '__main__':
+    import nlp_flask_server
+    nlp_flask_server.main()
@@ -0,0 +1,80 @@
+"""
+Process pool for the pure-Python scorers (e.g. VADER), which hold the GIL and would serialize
+the request threads. Each worker builds its scorer once and keeps it for its whole life.
+The workers are spawned, so they do not inherit the torch and flair state (or the threads) of the server.
+A spawned worker runs the main script again (as __mp_main__) and then only imports this module and vaderSentiment:
+the server must be started from a main script that imports nothing else under __mp_main__ (run_server.py, or gunicorn)
+"""
+import threading
+import multiprocessing
+import concurrent.futures
+from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+
+
+class VaderScorer:
+	"""
+	Lexicon-based VADER sentiment on a list of texts
+	"""
+	def __init__(self):
+		self.sentiment_analyzer = SentimentIntensityAnalyzer()
+
+	def __call__(self, texts):
+		return [None if text is None or text == '' else self.sentiment_analyzer.polarity_scores(text)['compound'] for text in texts]
+
+
+_worker_scorer = None
+
+def _init_worker(scorer_factory):
+	global _worker_scorer
+	_worker_scorer = scorer_factory()
+
+def _score_chunk(texts):
+	return _worker_scorer(texts)
+
+
+class ScorerProcessPool:
+	def __init__(self, scorer_factory, processes=None, chunk_size=128):
+		"""
+		@param scorer_factory: a picklable callable (e.g. a class defined in this module) building the scorer in each worker.
+		                       The scorer takes a list of texts and returns a list of results
+		@param processes: the number of worker processes, defaults to the number of cores
+		@param chunk_size: the number of texts sent to a worker at once
+		"""
+		self.scorer_factory = scorer_factory
+		self.processes = processes
+		self.chunk_size = chunk_size
+		self.executor = None
+		self.lock = threading.Lock()
+
+	def get_executor(self):
+		# the workers are started on the first call, in the process that uses them
+		with self.lock:
+			if self.executor is None:
+				self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context('spawn'),
+																	   initializer=_init_worker, initargs=(self.scorer_factory,))
+			return self.executor
+
+	def submit(self, texts):
+		"""
+		Queues all the chunks of the texts to the worker processes at once
+		@return the futures of the lists of results of the chunks, in the same order of texts
+		"""
+		texts = list(texts)
+		executor = self.get_executor()
+		return [executor.submit(_score_chunk, texts[i:i+self.chunk_size]) for i in range(0, len(texts), self.chunk_size)]
+
+	def map(self, texts):
+		"""
+		Scores the texts in chunks across the worker processes
+		@return the list of results, in the same order of texts
+		"""
+		result = []
+		for future in self.submit(texts):
+			result.extend(future.result())
+		return result
+
+	def shutdown(self):
+		with self.lock:
+			if self.executor is not None:
+				self.executor.shutdown()
+				self.executor = None
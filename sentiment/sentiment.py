@@ -8,6 +8,11 @@ import flair
 from flair.models import TextClassifier
 from flair.data import Sentence
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+from scorer_pool import ScorerProcessPool, VaderScorer
+try:
+	from timing import stage
+except ImportError: # outside the server the stages are not timed
+	from contextlib import nullcontext as stage
 
 
 class SentimentClassifier:
@@ -16,12 +21,26 @@ class SentimentClassifier:
 	@param is_cuda: to enable cuda
 	"""
 
-	def __init__(self, is_cuda=False):
+	def __init__(self, is_cuda=False, flair_mini_batch_size=32, vader_processes=0, vader_chunk_size=128):
 		"""
 		@param is_cuda: to enable cuda (only relevant to flair sentiment computation)
+		@param flair_mini_batch_size: the number of sentences flair predicts together in the list methods
+		@param vader_processes: the number of worker processes scoring VADER on large lists, 0 to run it in the calling thread
+		@param vader_chunk_size: the number of texts sent to a VADER worker at once, shorter lists run in the calling thread
 		"""
 		self.is_cuda = is_cuda
+		self.flair_mini_batch_size = flair_mini_batch_size
+		self.vader_chunk_size = vader_chunk_size
+		self.vader_pool = ScorerProcessPool(VaderScorer, vader_processes, vader_chunk_size) if vader_processes > 0 else None
 		self.HateSonar = Sonar()
+		# HateSonar's vectorizer and classifier, called directly to score a list of texts at once.
+		# The order of the classes is taken from ping, so the scores are the same of the per-text calls
+		self.hate_sonar_vectorizer = None
+		for attribute in ['preprocess', 'preprocessor']:
+			if getattr(self.HateSonar, attribute, None) is not None:
+				self.hate_sonar_vectorizer = getattr(self.HateSonar, attribute)
+		self.hate_sonar_estimator = getattr(self.HateSonar, 'estimator', None)
+		self.hate_sonar_classes = [c['class_name'] for c in self.HateSonar.ping('hello')['classes']]
 		self.sentiment_analyzer = SentimentIntensityAnalyzer()
 		self.flair_classifier = TextClassifier.load('en-sentiment')
 
@@ -58,6 +77,37 @@ class SentimentClassifier:
 		return res
 
 
+	def share_memory(self):
+		"""
+		Moves the flair weights to shared memory, so that the workers forked after it share them
+		"""
+		self.flair_classifier.share_memory()
+
+	def hate_sonar_list(self, texts):
+		"""
+		Batched version of hate_sonar: all the texts go through HateSonar's vectorizer
+		and classifier in a single transform and predict call
+		@param texts: the list of texts
+		@return a list with a pair of estimators for hate_speech and offensive_language for each text
+		"""
+		if self.hate_sonar_vectorizer is None or self.hate_sonar_estimator is None:
+			return [self.hate_sonar(text) for text in texts]
+		result = [[None, None] for _ in texts]
+		ids = [i for i, text in enumerate(texts) if text is not None and text != '']
+		if ids:
+			X = self.hate_sonar_vectorizer.transform([str(texts[i]) for i in ids])
+			probabilities = self.hate_sonar_estimator.predict_proba(X)
+			for i, proba in zip(ids, probabilities):
+				res = [0,0]
+				for hate_category, hate_score in zip(self.hate_sonar_classes, proba):
+					if hate_category == 'hate_speech':
+						res[0] = hate_score
+					elif hate_category == 'offensive_language':
+						res[1] = hate_score
+				result[i] = res
+		return result
+
+
 	def vader_sentiment(self, text):
 		"""
 		Etimates sentiment polarity using a simple word matching approach
@@ -70,6 +120,29 @@ class SentimentClassifier:
 		return self.sentiment_analyzer.polarity_scores(text)['compound']
 
 
+	def vader_sentiment_list(self, texts):
+		"""
+		Batched version of vader_sentiment: lists longer than vader_chunk_size are split across the VADER worker processes
+		@param texts: the list of texts
+		@return the list of sentiment scores
+		"""
+		if self.vader_pool is not None and len(texts) > self.vader_chunk_size:
+			return self.vader_pool.map(texts)
+		return [self.vader_sentiment(text) for text in texts]
+
+
+	def submit_vader_sentiment_list(self, texts):
+		"""
+		Asynchronous version of vader_sentiment_list: all the chunks of the texts are queued to the VADER workers at once,
+		so that the caller can score the other models (e.g. on a part of the texts at a time) while they run
+		@param texts: the list of texts
+		@return an iterator over the sentiment scores, in the same order of texts
+		"""
+		if self.vader_pool is not None and len(texts) > self.vader_chunk_size:
+			return (score for future in self.vader_pool.submit(texts) for score in future.result())
+		return iter(self.vader_sentiment_list(texts))
+
+
 	def flair_sentiment_by_sentence(self, text):
 		"""
 		Etimates sentiment polarity using a deep-learning pre-trained model
@@ -83,21 +156,59 @@ class SentimentClassifier:
 		"""
 		if text is None or text == '':
 			return [None, None, None, None, None, None, None]
-		sentiment_neg = []
-		sentiment_pos = []
-		sentiment_all = sentiment_neg + sentiment_pos
+		scores = []
 		sentences = sent_tokenize(text)
 		for s in sentences:
 			flair_sentence = Sentence(s)
 			self.flair_classifier.predict(flair_sentence)
-			result = flair_sentence.labels[0]
-			sign = 1
-			if result.value == 'NEGATIVE':
-				score = -1 * result.score
-				sentiment_neg.append(score)
+			scores.append(self._flair_score(flair_sentence))
+		return self._aggregate_sentence_scores(scores)
+
+
+	def flair_sentiment_by_sentence_list(self, texts, mini_batch_size=None):
+		"""
+		Batched version of flair_sentiment_by_sentence: the sentences of all the texts
+		are predicted together in mini-batches
+		@param texts: the list of texts
+		@param mini_batch_size: the number of sentences predicted together, defaults to self.flair_mini_batch_size
+		@return the list of flair_sentiment_by_sentence results, one per text
+		"""
+		mini_batch_size = self.flair_mini_batch_size if mini_batch_size is None else mini_batch_size
+		flair_sentences = []
+		sentence_owners = []
+		for i, text in enumerate(texts):
+			if text is not None and text != '':
+				for s in sent_tokenize(text):
+					flair_sentences.append(Sentence(s))
+					sentence_owners.append(i)
+		if flair_sentences:
+			self.flair_classifier.predict(flair_sentences, mini_batch_size=mini_batch_size)
+		text2scores = {}
+		for i, flair_sentence in zip(sentence_owners, flair_sentences):
+			text2scores.setdefault(i, []).append(self._flair_score(flair_sentence))
+		result = []
+		for i, text in enumerate(texts):
+			if text is None or text == '':
+				result.append([None, None, None, None, None, None, None])
 			else:
-				score = result.score 
-				sentiment_pos.append(score)
+				result.append(self._aggregate_sentence_scores(text2scores.get(i, [])))
+		return result
+
+
+	def _flair_score(self, flair_sentence):
+		"""
+		@return the score of a predicted flair sentence, negative for the NEGATIVE label
+		"""
+		result = flair_sentence.labels[0]
+		if result.value == 'NEGATIVE':
+			return -1 * result.score
+		else:
+			return result.score
+
+
+	def _aggregate_sentence_scores(self, scores):
+		sentiment_neg = [score for score in scores if score < 0]
+		sentiment_pos = [score for score in scores if score >= 0]
 		sentiment_all = sentiment_neg + sentiment_pos
 		if sentiment_pos:
 			min_pos = min(sentiment_pos)
@@ -129,12 +240,25 @@ class SentimentClassifier:
 		else:
 			flair_sentence = Sentence(text)
 			self.flair_classifier.predict(flair_sentence)
-			result = flair_sentence.labels[0]
-			if result.value == 'NEGATIVE':
-				score = -1 * result.score
-			else:
-				score = result.score 
-			return score
+			return self._flair_score(flair_sentence)
+
+
+	def flair_sentiment_list(self, texts, mini_batch_size=None):
+		"""
+		Batched version of flair_sentiment: all the texts are predicted together in mini-batches
+		@param texts: the list of texts
+		@param mini_batch_size: the number of texts predicted together, defaults to self.flair_mini_batch_size
+		@return the list of sentiment scores (None for empty texts)
+		"""
+		mini_batch_size = self.flair_mini_batch_size if mini_batch_size is None else mini_batch_size
+		ids = [i for i, text in enumerate(texts) if text is not None and text != '']
+		flair_sentences = [Sentence(texts[i]) for i in ids]
+		if flair_sentences:
+			self.flair_classifier.predict(flair_sentences, mini_batch_size=mini_batch_size)
+		result = [None] * len(texts)
+		for i, flair_sentence in zip(ids, flair_sentences):
+			result[i] = self._flair_score(flair_sentence)
+		return result
 
 	def get_sentiment(self, text):
 		"""
@@ -142,5 +266,22 @@ class SentimentClassifier:
 		@param text: the text
 		@return a list with [vader_sentiment, flair_sentiment, hate_speech, offensive_language]
 		"""
-		return {'vader':self.vader_sentiment(text), 'flair':self.flair_sentiment(text), 'hate': self.hate_sonar(text)[0], 'offensive':self.hate_sonar(text)[1]}
+		hate, offensive = self.hate_sonar(text)
+		return {'vader':self.vader_sentiment(text), 'flair':self.flair_sentiment(text), 'hate': hate, 'offensive':offensive}
+
+	def get_sentiment_list(self, texts, vader=True):
+		"""
+		Returns sentiment from all estimators for a list of texts, flair and HateSonar run on the whole list
+		@param texts: the list of texts
+		@param vader: False to leave the vader scores to None, when the caller gets them from submit_vader_sentiment_list
+		@return a list with a get_sentiment dictionary for each text
+		"""
+		with stage('vader'):
+			vader_scores = self.vader_sentiment_list(texts) if vader else [None] * len(texts)
+		with stage('flair'):
+			flair_scores = self.flair_sentiment_list(texts)
+		with stage('hatesonar'):
+			hate_scores = self.hate_sonar_list(texts)
+		return [{'vader':vader_score, 'flair':flair_score, 'hate': hate, 'offensive':offensive}
+				for vader_score, flair_score, (hate, offensive) in zip(vader_scores, flair_scores, hate_scores)]
 
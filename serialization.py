@@ -0,0 +1,82 @@
+"""
+Request bodies and responses in JSON or msgpack, and streamed responses in NDJSON.
+orjson (optional) serializes the numpy scalars and arrays natively, in C. Without it the json module
+converts them in numpy_default, one value at a time
+"""
+import json
+import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPES = ['application/msgpack', 'application/x-msgpack']
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# NDJSON streams the results, one JSON object per line
+RESPONSE_MIMETYPES = [JSON_MIMETYPE] + MSGPACK_MIMETYPES + [NDJSON_MIMETYPE]
+
+
+def numpy_default(obj):
+    if isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def dumps(data, mimetype=JSON_MIMETYPE):
+    """
+    @return the bytes of data in the mimetype
+    """
+    if mimetype in MSGPACK_MIMETYPES:
+        if msgpack is None:
+            raise ImportError("msgpack is not installed, install it with pip install msgpack")
+        return msgpack.packb(data, default=numpy_default, use_bin_type=True)
+    if orjson is not None:
+        return orjson.dumps(data, default=numpy_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=numpy_default).encode('utf8')
+
+
+def loads(body, mimetype=JSON_MIMETYPE):
+    if mimetype in MSGPACK_MIMETYPES:
+        if msgpack is None:
+            raise ImportError("msgpack is not installed, install it with pip install msgpack")
+        return msgpack.unpackb(body, raw=False)
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def get_request_body(flask_request):
+    """
+    Decodes a JSON or msgpack request body
+    @return code and the body, None for form requests (or the error message)
+    """
+    mimetype = flask_request.mimetype
+    if mimetype != JSON_MIMETYPE and mimetype not in MSGPACK_MIMETYPES:
+        return 200, None
+    if mimetype in MSGPACK_MIMETYPES and msgpack is None:
+        return 415, "msgpack request bodies are not supported, msgpack is not installed on the server"
+    try:
+        body = loads(flask_request.get_data(), mimetype)
+    except Exception as e:
+        return 400, f"Invalid {mimetype} body: {e}"
+    if not isinstance(body, dict):
+        return 400, f"The {mimetype} body must be an object with a text field (and optionally id and no_encryption)"
+    return 200, body
+
+
+def get_response_mimetype(flask_request):
+    """
+    The response mimetype negotiated from the Accept header, JSON by default
+    """
+    mimetypes = RESPONSE_MIMETYPES if msgpack is not None else [JSON_MIMETYPE, NDJSON_MIMETYPE]
+    return flask_request.accept_mimetypes.best_match(mimetypes, default=JSON_MIMETYPE)
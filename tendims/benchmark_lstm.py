@@ -0,0 +1,81 @@
+"""
+Parity check and CPU benchmark of the per-dimension LSTMClassifier models (eager float32) against
+FusedLSTMClassifier and the other inference backends. The inputs are random vectors, so the embeddings are not needed:
+    python tendims/benchmark_lstm.py -m tendims/models/lstm_trained_models -e word2vec --backends int8 torchscript
+The float32 variants must match the eager scores, the int8 ones only report their drift
+"""
+import os
+import time
+from os.path import join
+from argparse import ArgumentParser
+import torch
+from models.lstm import LSTMClassifier, FusedLSTMClassifier, LSTM_BACKENDS, prepare_inference_model
+
+
+def load_models(models_dir, embedding):
+    dims, models = [], []
+    for modelname in sorted(os.listdir(models_dir)):
+        if ('-best.lstm' in modelname) & (embedding in modelname) & modelname.endswith('.pth'):
+            model = LSTMClassifier(embedding_dim=300, hidden_dim=300)
+            model.load_state_dict(torch.load(join(models_dir, modelname), map_location='cpu'))
+            model.eval()
+            dims.append(modelname.split('-')[0])
+            models.append(model)
+    return dims, models
+
+
+def random_batch(batch_size, max_len, embedding_dim=300):
+    lengths = torch.randint(1, max_len + 1, (batch_size,))
+    lengths, _ = lengths.sort()
+    batch = torch.zeros(batch_size, int(lengths.max()), embedding_dim)
+    for i, length in enumerate(lengths):
+        batch[i, :length] = torch.randn(int(length), embedding_dim)
+    return batch, lengths
+
+
+def run_separate(models, batch, lengths):
+    return torch.stack([model(batch, lengths).view(-1) for model in models], 1)
+
+
+def timeit(fun, repeats):
+    fun() # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fun()
+    return (time.perf_counter() - start) / repeats
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-m', '--models_dir', type=str, default='models/lstm_trained_models')
+    parser.add_argument('-e', '--embedding', type=str, default='word2vec', choices=['word2vec', 'glove', 'fasttext'])
+    parser.add_argument('-b', '--batch_sizes', nargs='+', type=int, default=[1, 8, 64, 256])
+    parser.add_argument('-l', '--max_len', type=int, default=40)
+    parser.add_argument('-r', '--repeats', type=int, default=10)
+    parser.add_argument('-t', '--threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--backends', nargs='*', default=[], choices=[b for b in LSTM_BACKENDS if b != 'eager'])
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    dims, models = load_models(args.models_dir, args.embedding)
+    print(f"{args.embedding} dimensions: {dims}, torch threads: {torch.get_num_threads()}")
+
+    fused = FusedLSTMClassifier(models).eval()
+    variants = {'fused': lambda batch, lengths: fused(batch, lengths)}
+    for backend in args.backends:
+        backend_models = [prepare_inference_model(model, backend) for model in load_models(args.models_dir, args.embedding)[1]]
+        variants[backend] = lambda batch, lengths, backend_models=backend_models: run_separate(backend_models, batch, lengths)
+
+    with torch.no_grad():
+        for batch_size in args.batch_sizes:
+            batch, lengths = random_batch(batch_size, args.max_len)
+            eager_scores = torch.sigmoid(run_separate(models, batch, lengths))
+            eager_time = timeit(lambda: run_separate(models, batch, lengths), args.repeats)
+            print(f"batch {batch_size:4d}\t{'eager':16s}\t{eager_time*1000:8.2f} ms")
+            for name, run in variants.items():
+                max_diff = (eager_scores - torch.sigmoid(run(batch, lengths))).abs().max().item()
+                if not name.startswith('int8'):
+                    assert max_diff < 1e-4, f"{name} scores differ from the eager models: {max_diff}"
+                variant_time = timeit(lambda: run(batch, lengths), args.repeats)
+                print(f"batch {batch_size:4d}\t{name:16s}\t{variant_time*1000:8.2f} ms\tspeedup {eager_time/variant_time:5.2f}x\tmax score diff {max_diff:.2e}")
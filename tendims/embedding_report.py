@@ -0,0 +1,50 @@
+"""
+Compares a compact (pruned and/or quantized) embedding store against the full-precision one:
+memory used by the vectors and drift of the ten dimensions scores on a corpus (one text per line)
+    python tendims/embedding_report.py -d tendims/embeddings -m tendims/models/lstm_trained_models -c compact --corpus messages.txt
+"""
+from argparse import ArgumentParser
+import numpy as np
+from tendims import TenDimensionsClassifier
+
+
+def format_size(size):
+    return f"{size / 2**20:10.1f} MB"
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-d', '--emb_dir', type=str, default='embeddings')
+    parser.add_argument('-m', '--models_dir', type=str, default='models/lstm_trained_models')
+    parser.add_argument('-r', '--reference_store', type=str, default='store')
+    parser.add_argument('-c', '--compact_store', type=str, required=True)
+    parser.add_argument('--corpus', type=str, required=True, help='text file with one text per line')
+    parser.add_argument('--limit', type=int, default=5000, help='maximum number of texts to score')
+    args = parser.parse_args()
+
+    with open(args.corpus, encoding='utf-8') as f:
+        texts = [line.strip() for line in f if line.strip()][:args.limit]
+
+    reference = TenDimensionsClassifier(models_dir=args.models_dir, embeddings_dir=args.emb_dir, embedding_store=args.reference_store)
+    compact = TenDimensionsClassifier(models_dir=args.models_dir, embeddings_dir=args.emb_dir, embedding_store=args.compact_store)
+
+    print(f"\nMemory ({args.reference_store} -> {args.compact_store})")
+    total_reference = total_compact = 0
+    for emb_name in ['em_glove', 'em_word2vec', 'em_fasttext']:
+        em_reference, em_compact = getattr(reference, emb_name), getattr(compact, emb_name)
+        total_reference += em_reference.memory_size()
+        total_compact += em_compact.memory_size()
+        print(f"{em_reference.emb_type:10s} words {em_reference.vocab_size:9d} -> {em_compact.vocab_size:9d}"
+              f"\tvectors {format_size(em_reference.memory_size())} -> {format_size(em_compact.memory_size())}")
+    print(f"{'total':10s} {'':35s}\tvectors {format_size(total_reference)} -> {format_size(total_compact)}")
+
+    print(f"\nScore drift on {len(texts)} texts")
+    reference_scores = reference.compute_score_batch(texts)
+    compact_scores = compact.compute_score_batch(texts)
+    for dim in reference.dimensions_list:
+        pairs = [(r[dim], c[dim]) for r, c in zip(reference_scores, compact_scores) if r[dim] is not None and c[dim] is not None]
+        if not pairs:
+            print(f"{dim:12s} not computed")
+            continue
+        diff = np.abs(np.array([r for r, _ in pairs]) - np.array([c for _, c in pairs]))
+        print(f"{dim:12s} mean abs diff {diff.mean():.5f}\tmax abs diff {diff.max():.5f}")
@@ -1,5 +1,7 @@
 from os.path import join
 import os.path
+import mmap
+import hashlib
 import numpy as np
 
 import numpy as np
@@ -50,65 +52,287 @@ class ExtractEmbeddingSimilarities(BaseEstimator,TransformerMixin):
         return ['emb:dim-%d'%i for i in range(len(self.ground_embedding))]+['emb:similarity']
 
 
-# loads all pretrained word embeddings under the wv format using Gensim
+# original embedding files, relative to the embeddings directory
+EMBEDDING_SOURCES = {
+    'word2vec': 'word2vec/GoogleNews-vectors-negative300.bin.gz',
+    'fasttext': 'fasttext/wiki-news-300d-1M-subword.vec',
+    'glove': 'glove/glove.42B.300d.txt',
+}
+STORE_VECTORS_FILE = 'vectors.npy'
+STORE_VOCAB_FILE = 'vocab.txt'
+STORE_VOCAB_HASHES_FILE = 'vocab_hashes.npy'
+STORE_VOCAB_ROWS_FILE = 'vocab_rows.npy'
+STORE_UNK_FILE = 'unk.npy'
+STORE_SCALES_FILE = 'scales.npy'
+STORE_DTYPES = ['float32', 'float16', 'int8']
+
+
+def get_store_dir(emb_type, emb_dir, store_name='store'):
+    return join(emb_dir, emb_type.lower(), store_name)
+
+
+def hash_words(words):
+    """
+    @return the uint64 hashes of the words, the same in every process and run (unlike hash())
+    """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(w.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little') for w in words),
+                       dtype=np.uint64, count=len(words))
+
+
+def index_vocabulary(store_dir):
+    """
+    Writes the vocabulary index of a store from its vocab.txt:
+        vocab_hashes.npy: the sorted hashes of the words
+        vocab_rows.npy: the row in vectors.npy of each hash
+    Unlike a dict of the words, the index is memory-mapped and shared by every process opening the store.
+    The words are looked up by hash, two words with the same 64-bit hash (unlikely) keep the most frequent one
+    """
+    with open(join(store_dir, STORE_VOCAB_FILE), encoding='utf-8', newline='') as f:
+        words = f.read().split('\n')
+    hashes = hash_words(words)
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    keep = np.ones(len(hashes), dtype=bool)
+    keep[1:] = hashes[1:] != hashes[:-1]
+    np.save(join(store_dir, STORE_VOCAB_HASHES_FILE), hashes[keep])
+    np.save(join(store_dir, STORE_VOCAB_ROWS_FILE), order[keep].astype(np.int32))
+
+
+def quantize_vectors(vectors, dtype='float32'):
+    """
+    @param vectors: float32 matrix of vectors
+    @param dtype: float32, float16 or int8. int8 rows are scaled by their maximum absolute value
+    @return the converted matrix and the float32 scale of each row (None unless int8)
+    """
+    if dtype=='float32':
+        return np.ascontiguousarray(vectors, dtype=np.float32), None
+    elif dtype=='float16':
+        return np.ascontiguousarray(vectors, dtype=np.float16), None
+    elif dtype=='int8':
+        scales = np.abs(vectors).max(1).astype(np.float32) / 127
+        scales[scales==0] = 1
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales
+    else:
+        raise ValueError('Unrecognized store dtype: %s'%dtype)
+
+
+def load_keyed_vectors(emb_type, emb_dir):
+    """
+    Parses the original embedding files with Gensim (slow, it takes minutes for the big vocabularies)
+    @return the KeyedVectors model and the path of the file it was loaded from
+    """
+    from gensim.models import KeyedVectors
+
+    emb_type = emb_type.lower()
+    if emb_type=='word2vec':
+        load_dir = join(emb_dir,EMBEDDING_SOURCES['word2vec'])
+        print(f"loading {load_dir}")
+        model = KeyedVectors.load_word2vec_format(load_dir, binary=True)
+    elif emb_type=='fasttext': 
+        load_dir = join(emb_dir,EMBEDDING_SOURCES['fasttext'])
+        print(f"loading {load_dir}")
+        model = KeyedVectors.load_word2vec_format(load_dir)
+    elif emb_type=='glove':
+        # load_dir = join(emb_dir,'glove/glove.twitter.27B.200d.wv')
+        # load_dir = join(emb_dir,'glove/glove.42B.300d.wv')
+        load_dir = join(emb_dir,EMBEDDING_SOURCES['glove'])
+        output = join(emb_dir,'glove/glove.42B.300d_converted.txt')
+        if not os.path.isfile(output):
+            print("Converting glove file")
+            glove2word2vec(glove_input_file=load_dir, word2vec_output_file=output)
+        print(f"loading {output}")
+        model = KeyedVectors.load_word2vec_format(output, binary=False)
+        load_dir = output
+    else:
+        raise ValueError('Unrecognized embedding type: %s'%emb_type)
+    return model, load_dir
+
+
+def prepare_embeddings(emb_type, emb_dir, store_dir=None, top_n=None, vocab_words=None, dtype='float32'):
+    """
+    One-time conversion of the original embedding files into a native binary store:
+        vectors.npy: the matrix of vectors, one row per word
+        vocab.txt: the words, one per line, in the same order as the matrix rows
+        vocab_hashes.npy and vocab_rows.npy: the index of the words, see index_vocabulary
+        unk.npy: the float32 vector used for unknown words
+        scales.npy: the float32 scale of each row, only for int8 stores
+    ExtractWordEmbeddings opens the store read-only and memory-mapped, so it loads in
+    seconds and every process using it shares the same physical pages
+    @param emb_type: word2vec, fasttext or glove
+    @param emb_dir: the directory containing the original embedding files
+    @param store_dir: where to write the store, defaults to [emb_dir]/[emb_type]/store
+    @param top_n: to keep only the first top_n words (the embedding files are sorted by frequency)
+    @param vocab_words: to keep only these words, e.g. the tokens of a corpus (their lowercase forms are kept too)
+    @param dtype: float32, float16 or int8 (with a per-row scale)
+    @return the store directory
+    """
+    emb_type = emb_type.lower()
+    store_dir = get_store_dir(emb_type, emb_dir) if store_dir is None else store_dir
+    model, load_dir = load_keyed_vectors(emb_type, emb_dir)
+    # UNK is computed on the full vocabulary, so it does not change with the pruning
+    if emb_type=='word2vec':
+        unk = model['UNK']
+    else:
+        unk = model.vectors.mean(0) # UNK as just the average of all vectors
+
+    words = model.index2word
+    vectors = model.vectors
+    if top_n is not None or vocab_words is not None:
+        if vocab_words is not None:
+            vocab_words = set(vocab_words)
+            vocab_words.update([w.lower() for w in vocab_words])
+        keep = [i for i, w in enumerate(words[:top_n]) if vocab_words is None or w in vocab_words]
+        words = [words[i] for i in keep]
+        vectors = vectors[keep]
+    vectors, scales = quantize_vectors(vectors, dtype)
+
+    os.makedirs(store_dir, exist_ok=True)
+    print(f"writing {len(words)}/{len(model.index2word)} {dtype} vectors from {load_dir} to {store_dir}")
+    np.save(join(store_dir, STORE_VECTORS_FILE), vectors)
+    np.save(join(store_dir, STORE_UNK_FILE), np.asarray(unk, dtype=np.float32))
+    if scales is not None:
+        np.save(join(store_dir, STORE_SCALES_FILE), scales)
+    elif os.path.isfile(join(store_dir, STORE_SCALES_FILE)):
+        os.remove(join(store_dir, STORE_SCALES_FILE))
+    with open(join(store_dir, STORE_VOCAB_FILE), 'w', encoding='utf-8', newline='') as f:
+        f.write('\n'.join(words))
+    index_vocabulary(store_dir)
+    return store_dir
+
+
+def to_shared_array(array):
+    """
+    @return a copy of the array in an anonymous shared memory map: the forked processes
+            keep sharing its pages instead of copying them on write
+    """
+    buffer = mmap.mmap(-1, max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=buffer)
+    shared[...] = array
+    return shared
+
+
+# loads all pretrained word embeddings from the memory-mapped store written by prepare_embeddings,
+# or from the original files using Gensim if the store does not exist
 class ExtractWordEmbeddings():
     def __init__(self,emb_type='word2vec',
                  emb_dir='/10TBdrive/minje/features/embeddings',
-                 method='average'):
-        from gensim.models import KeyedVectors
-
+                 method='average',
+                 store_dir=None,
+                 store_name='store'):
         emb_type = emb_type.lower()
-        if emb_type=='word2vec':
-            load_dir = join(emb_dir,'word2vec/GoogleNews-vectors-negative300.bin.gz')
+        store_dir = get_store_dir(emb_type, emb_dir, store_name) if store_dir is None else store_dir
+        self.model = None
+        self.scales = None
+        # the words are looked up in the memory-mapped index of the store, or in this dict without a store (or with an old one)
+        self.word2index = None
+        if os.path.isfile(join(store_dir, STORE_VECTORS_FILE)):
+            load_dir = store_dir
             print(f"loading {load_dir}")
-            self.model = KeyedVectors.load_word2vec_format(load_dir, binary=True)
-        elif emb_type=='fasttext': 
-            load_dir = join(emb_dir,'fasttext/wiki-news-300d-1M-subword.vec')
-            print(f"loading {load_dir}")
-            self.model = KeyedVectors.load_word2vec_format(load_dir)
-        elif emb_type=='glove':
-            # load_dir = join(emb_dir,'glove/glove.twitter.27B.200d.wv')
-            # load_dir = join(emb_dir,'glove/glove.42B.300d.wv')
-            load_dir = join(emb_dir,'glove/glove.42B.300d.txt')
-            output = join(emb_dir,'glove/glove.42B.300d_converted.txt')
-            if not os.path.isfile(output):
-                print("Converting glove file")
-                glove2word2vec(glove_input_file=load_dir, word2vec_output_file=output)
-            # self.model = KeyedVectors.load(load_dir,mmap='r')
-            print(f"loading {output}")
-            self.model = KeyedVectors.load_word2vec_format(output, binary=False)
+            # read-only memory map, the pages are shared by every process opening the store
+            self.vectors = np.load(join(store_dir, STORE_VECTORS_FILE), mmap_mode='r')
+            self.UNK = np.load(join(store_dir, STORE_UNK_FILE))
+            if os.path.isfile(join(store_dir, STORE_SCALES_FILE)):
+                self.scales = np.load(join(store_dir, STORE_SCALES_FILE), mmap_mode='r')
+            if os.path.isfile(join(store_dir, STORE_VOCAB_HASHES_FILE)):
+                self.vocab_hashes = np.load(join(store_dir, STORE_VOCAB_HASHES_FILE), mmap_mode='r')
+                self.vocab_rows = np.load(join(store_dir, STORE_VOCAB_ROWS_FILE), mmap_mode='r')
+            else:
+                print(f"No vocabulary index in {store_dir}, run prepare_embeddings.py --index_only to share it across the processes")
+                with open(join(store_dir, STORE_VOCAB_FILE), encoding='utf-8', newline='') as f:
+                    self.word2index = {w: i for i, w in enumerate(f.read().split('\n'))}
+        else:
+            print(f"No embedding store in {store_dir}, run prepare_embeddings.py to speed up the loading")
+            self.model, load_dir = load_keyed_vectors(emb_type, emb_dir)
+            self.vectors = self.model.vectors
+            self.word2index = {w: i for i, w in enumerate(self.model.index2word)}
+            self.UNK = self.model.vectors.mean(0) # UNK as just the average of all vectors
+            if emb_type=='word2vec':
+                self.UNK = self.model['UNK']
 
         self.emb_type = emb_type
         self.method = method
 
-        self.UNK = self.model.vectors.mean(0) # UNK as just the average of all vectors
-        if emb_type=='word2vec':
-            self.UNK = self.model['UNK']
         print("Loaded word embeddings from %s!"%load_dir)
-        print("Vocab size: %d" %len(self.model.vocab))
+        self.vocab_size = len(self.word2index) if self.word2index is not None else len(self.vocab_hashes)
+        print("Vocab size: %d" %self.vocab_size)
         return
 
+    def share_memory(self):
+        """
+        Moves the vectors loaded in the heap (from the original files) to shared memory, before forking the workers.
+        The memory-mapped stores are already shared
+        """
+        if not isinstance(self.vectors, np.memmap):
+            self.vectors = to_shared_array(self.vectors)
+            if self.model is not None:
+                self.model.vectors = self.vectors
+
+    def memory_size(self):
+        """
+        @return the size in bytes of the vector matrix (and the int8 scales)
+        """
+        size = self.vectors.nbytes
+        if self.scales is not None:
+            size += self.scales.nbytes
+        return size
+
     def fit(self,X):
         return
 
+    # returns the row of each word in self.vectors (-1 for unknown words), as they are written
+    def lookup_words(self, words):
+        if self.word2index is not None:
+            return np.array([self.word2index.get(word, -1) for word in words], dtype=np.int64)
+        hashes = hash_words(words)
+        positions = np.minimum(np.searchsorted(self.vocab_hashes, hashes), len(self.vocab_hashes) - 1)
+        return np.where(self.vocab_hashes[positions] == hashes, self.vocab_rows[positions], -1).astype(np.int64)
+
+    # from any sentence, returns the row of each word in self.vectors (-1 for unknown words)
+    def obtain_indices_from_sentence(self, words, include_unk=True):
+        words = list(words)
+        rows = self.lookup_words(words)
+        missing = np.flatnonzero(rows < 0)
+        if len(missing):
+            rows[missing] = self.lookup_words([words[i].lower() for i in missing])
+        if not include_unk:
+            rows = rows[rows >= 0]
+        return rows.tolist()
+
+    # one fancy-indexing gather from the vector matrix, -1 rows get the UNK vector
+    # float16 and int8 stores are dequantized to float32
+    def gather_vectors(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        rows = np.maximum(indices, 0)
+        out = np.array(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            out *= self.scales[rows][:, None]
+        out[indices < 0] = self.UNK
+        return out
+
     # from any sentence, returns word vectors
     def obtain_vectors_from_sentence(self, words, include_unk=True):
-        out = []
-        for word in words:
-            if word in self.model:
-                vec = self.model[word]
-            elif word.lower() in self.model:
-                vec = self.model[word.lower()]
-            else:
-                if include_unk:
-                    vec = self.UNK
-                else:
-                    continue
-            out.append(vec.tolist())
-        if len(out)==0:
+        indices = self.obtain_indices_from_sentence(words, include_unk)
+        if len(indices)==0:
             return np.zeros(len(self.UNK)).reshape(1,-1)
         else:
-            return np.array(out)
+            return self.gather_vectors(indices)
+
+    def obtain_vectors_from_sentences(self, sentences, include_unk=True):
+        """
+        Batched version of obtain_vectors_from_sentence
+        :param sentences: list of tokenized sentences (lists of words)
+        :return: a pair (vectors, lengths) where vectors is a zero-padded float32 array [b x max_len x dim]
+                 and lengths the number of vectors of each sentence. Like obtain_vectors_from_sentence,
+                 a sentence without any vector gets a single zero vector (length 1)
+        """
+        indices = [self.obtain_indices_from_sentence(words, include_unk) for words in sentences]
+        n_vectors = np.array([len(idx) for idx in indices], dtype=np.int64)
+        lengths = np.maximum(n_vectors, 1)
+        max_len = int(lengths.max()) if len(lengths) else 1
+        out = np.zeros((len(indices), max_len, len(self.UNK)), dtype=np.float32)
+        mask = np.arange(max_len) < n_vectors[:, None] # row-major order matches the concatenated indices
+        out[mask] = self.gather_vectors([idx for sent_indices in indices for idx in sent_indices])
+        return out, lengths
 
     def transform(self, X):
         """
@@ -2,6 +2,12 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 import os
+from typing import Optional
+
+# eager: float32 modules
+# int8: dynamic int8 quantization of the nn.LSTM and W_out layers
+# torchscript, int8_torchscript: the same, compiled with TorchScript
+LSTM_BACKENDS = ['eager', 'int8', 'torchscript', 'int8_torchscript']
 
 class LSTMClassifier(nn.Module):
     def __init__(self, embedding_dim, hidden_dim):
@@ -13,21 +19,114 @@ class LSTMClassifier(nn.Module):
         self.lstm = nn.LSTM(embedding_dim, hidden_dim,batch_first=True)
         self.W_out = nn.Linear(hidden_dim,1)
 
-    def forward(self, batch):
+    def forward(self, batch, lengths: Optional[torch.Tensor]=None):
         """
 
         :param batch of size [b @ (seq x dim)]
+        :param lengths: lengths of non-padded items [b], computed from the batch if None
         :return: array of size [b]
         """
-        lengths = (batch!=0).sum(1)[:,0] # lengths of non-padded items
+        if lengths is None:
+            lengths = (batch!=0).sum(1)[:,0] # lengths of non-padded items
         lstm_outs, _ = self.lstm(batch) # [b x seq x dim]
-        out = torch.stack([lstm_outs[i,idx-1] for i,idx in enumerate(lengths)])
+        lengths = lengths.to(lstm_outs.device)
+        out = lstm_outs[torch.arange(lstm_outs.size(0), device=lstm_outs.device), lengths-1] # last hidden state of each item
         out = self.W_out(out).squeeze()
         # out = torch.sigmoid(out).squeeze()
 
         return out
 
 
+def prepare_inference_model(model, backend='eager', cache_file=None, source_file=None):
+    """
+    Prepares a float32 model for CPU inference with one of the LSTM_BACKENDS
+    :param model: the LSTMClassifier with its trained weights
+    :param cache_file: where the TorchScript backends save the compiled model, it is reused
+                       by the following calls as long as it is newer than source_file
+    :param source_file: the .pth file of the weights
+    :return: the model to run
+    """
+    if backend not in LSTM_BACKENDS:
+        raise ValueError('Unrecognized LSTM backend: %s'%backend)
+    scripted = backend.endswith('torchscript')
+    if scripted and cache_file is not None and os.path.isfile(cache_file):
+        if source_file is None or os.path.getmtime(cache_file) >= os.path.getmtime(source_file):
+            try:
+                return torch.jit.load(cache_file, map_location='cpu').eval()
+            except Exception as e:
+                print(f"Could not load {cache_file}, compiling the model again: {e}")
+
+    model = model.eval()
+    if backend.startswith('int8'):
+        model = torch.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    if scripted:
+        model = torch.jit.script(model)
+        if cache_file is not None:
+            try:
+                torch.jit.save(model, cache_file)
+            except Exception as e:
+                print(f"Could not cache the compiled model in {cache_file}: {e}")
+    return model
+
+
+def get_cache_file(source_file, backend):
+    """
+    :return: the file caching the compiled model, next to the .pth file of the weights
+    """
+    return os.path.splitext(source_file)[0] + f'.{backend}.pt'
+
+
+class FusedLSTMClassifier(nn.Module):
+    """
+    Inference-only engine running several LSTMClassifier models of the same size on the same batch.
+    The weights are stacked so that the input projection of all the models is a single matmul
+    and each recurrent step is a single batched matmul over the models
+    """
+    def __init__(self, models):
+        super(FusedLSTMClassifier, self).__init__()
+
+        self.n_models = len(models)
+        self.hidden_dim = models[0].hidden_dim
+        self.embedding_dim = models[0].embedding_dim
+
+        with torch.no_grad():
+            lstms = [m.lstm for m in models]
+            # gates are ordered as in nn.LSTM: input, forget, cell, output
+            self.register_buffer('W_ih', torch.cat([l.weight_ih_l0 for l in lstms], 0).t().contiguous()) # [dim x n*4h]
+            self.register_buffer('b_gates', torch.cat([l.bias_ih_l0 + l.bias_hh_l0 for l in lstms], 0)) # [n*4h]
+            self.register_buffer('W_hh', torch.stack([l.weight_hh_l0.t() for l in lstms], 0).contiguous()) # [n x h x 4h]
+            self.register_buffer('W_out', torch.stack([m.W_out.weight.view(-1, 1) for m in models], 0)) # [n x h x 1]
+            self.register_buffer('b_out', torch.stack([m.W_out.bias.view(1, 1) for m in models], 0)) # [n x 1 x 1]
+
+    def forward(self, batch, lengths=None):
+        """
+
+        :param batch of size [b @ (seq x dim)]
+        :param lengths: lengths of non-padded items [b], computed from the batch if None
+        :return: array of size [b x n_models], the output of each model
+        """
+        if lengths is None:
+            lengths = (batch!=0).sum(1)[:,0] # lengths of non-padded items
+        b, seq_len, _ = batch.shape
+        n, h_dim = self.n_models, self.hidden_dim
+        # same index as LSTMClassifier: length 0 picks the last item
+        last_idx = ((lengths.to(batch.device) - 1) % seq_len).view(1, b, 1)
+
+        x_gates = torch.addmm(self.b_gates, batch.reshape(b * seq_len, -1), self.W_ih)
+        x_gates = x_gates.view(b, seq_len, n, 4 * h_dim).permute(1, 2, 0, 3) # [seq x n x b x 4h]
+        h = batch.new_zeros(n, b, h_dim)
+        c = batch.new_zeros(n, b, h_dim)
+        last = batch.new_zeros(n, b, h_dim)
+        for t in range(seq_len):
+            gates = torch.baddbmm(x_gates[t], h, self.W_hh) # [n x b x 4h]
+            i, f, g, o = gates.chunk(4, 2)
+            c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+            h = torch.sigmoid(o) * torch.tanh(c)
+            last = torch.where(last_idx == t, h, last)
+        out = torch.baddbmm(self.b_out, last, self.W_out).squeeze(2) # [n x b]
+        return out.t()
+
+
 # os.chdir('../')
 # from features.embedding_features import ExtractWordEmbeddings
 # em = ExtractWordEmbeddings('glove',
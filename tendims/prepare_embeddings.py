@@ -0,0 +1,45 @@
+"""
+Converts the original embedding files into the memory-mapped stores read by ExtractWordEmbeddings.
+It only needs to run once (and again if the original files change):
+    python tendims/prepare_embeddings.py -d tendims/embeddings
+A compact store can be built by pruning the vocabulary and quantizing the vectors:
+    python tendims/prepare_embeddings.py -d tendims/embeddings -n compact --top_n 200000 --dtype int8
+    python tendims/prepare_embeddings.py -d tendims/embeddings -n compact --corpus messages.txt --dtype float16
+and used by setting ten_dims_embedding_store: "compact" in the server config.
+The stores written before the vocabulary index only need the index:
+    python tendims/prepare_embeddings.py -d tendims/embeddings --index_only
+"""
+from argparse import ArgumentParser
+from features.embedding_features import EMBEDDING_SOURCES, STORE_DTYPES, get_store_dir, prepare_embeddings, index_vocabulary
+
+
+def read_corpus_words(corpus_filename):
+    from nltk.tokenize import TweetTokenizer
+    tokenize = TweetTokenizer().tokenize
+    words = set()
+    with open(corpus_filename, encoding='utf-8') as f:
+        for line in f:
+            words.update(tokenize(line))
+    return words
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-d', '--emb_dir', type=str, default='embeddings', help='directory containing the original embedding files')
+    parser.add_argument('-t', '--types', nargs='+', default=list(EMBEDDING_SOURCES.keys()), choices=list(EMBEDDING_SOURCES.keys()))
+    parser.add_argument('-n', '--store_name', type=str, default='store', help='the store is written in [emb_dir]/[type]/[store_name]')
+    parser.add_argument('--top_n', type=int, default=None, help='keep only the top_n most frequent words')
+    parser.add_argument('--corpus', type=str, default=None, help='keep only the words of this text file (one text per line)')
+    parser.add_argument('--dtype', type=str, default='float32', choices=STORE_DTYPES)
+    parser.add_argument('--index_only', action='store_true', help='only write the vocabulary index of the existing stores')
+    args = parser.parse_args()
+    vocab_words = read_corpus_words(args.corpus) if args.corpus is not None and not args.index_only else None
+    for emb_type in args.types:
+        if args.index_only:
+            store_dir = get_store_dir(emb_type, args.emb_dir, args.store_name)
+            index_vocabulary(store_dir)
+            print(f"{emb_type} vocabulary index written to {store_dir}")
+        else:
+            store_dir = prepare_embeddings(emb_type, args.emb_dir, store_dir=get_store_dir(emb_type, args.emb_dir, args.store_name),
+                                           top_n=args.top_n, vocab_words=vocab_words, dtype=args.dtype)
+            print(f"{emb_type} store written to {store_dir}")
@@ -1,18 +1,24 @@
 import sys
 import os
+import threading
 import numpy as np
 from os.path import join
 from features.embedding_features import ExtractWordEmbeddings
-from models.lstm import LSTMClassifier
+from models.lstm import LSTMClassifier, FusedLSTMClassifier, prepare_inference_model, get_cache_file
 import torch
 from nltk.tokenize import TweetTokenizer
 tokenize = TweetTokenizer().tokenize
 from nltk import sent_tokenize
+try:
+	from timing import stage
+except ImportError: # outside the server the stages are not timed
+	from contextlib import nullcontext as stage
 
+EMBEDDING_NAMES = ['glove', 'word2vec', 'fasttext']
 TEN_DIMENSIONS = ['support', 'knowledge', 'conflict', 'power', 'similarity', 'fun', 'status', 'trust', 'identity', 'romance']
 
 class TenDimensionsClassifier:
-	def __init__(self, models_dir = './models/lstm_trained_models', embeddings_dir = 'C:\\Users\\lajel\\embeddings', is_cuda=False):
+	def __init__(self, models_dir = './models/lstm_trained_models', embeddings_dir = 'C:\\Users\\lajel\\embeddings', is_cuda=False, batch_size=64, fused=False, embedding_store='store', backend='eager', lazy=False):
 		"""
 		@param models_dir: the directory where the LSTM models are stored
 		@param embeddings_dir: the directory where the embeddings are stored. The directory must contain the following subdirectories:
@@ -20,49 +26,159 @@ class TenDimensionsClassifier:
 		                       fasttext/wiki-news-300d-1M-subword.wv
 		                       glove/glove.42B.300d.wv
 		@param is_cuda: to enable cuda
+		@param batch_size: the maximum number of texts padded together in a single forward pass
+		@param fused: to score all the dimensions sharing an embedding with a single FusedLSTMClassifier
+		@param embedding_store: the name of the embedding stores written by prepare_embeddings.py,
+		                        e.g. a pruned or quantized store
+		@param backend: the CPU inference backend of the dimension models, one of models.lstm.LSTM_BACKENDS
+		                (not used by the fused engine). The TorchScript backends cache the compiled models next to the .pth files
+		@param lazy: to load each embedding and each dimension model the first time a text needs it
+		             (or with warmup) instead of loading everything here
 		"""
 		self.is_cuda = is_cuda 
+		self.batch_size = batch_size
 		self.models_dir = models_dir
 		self.embeddings_dir = embeddings_dir
-
-		#load embeddings
-		self.em_glove = ExtractWordEmbeddings('glove' ,emb_dir=self.embeddings_dir)
-		self.em_word2vec = ExtractWordEmbeddings('word2vec', emb_dir=self.embeddings_dir)
-		self.em_fasttext = ExtractWordEmbeddings('fasttext', emb_dir=self.embeddings_dir)
+		self.embedding_store = embedding_store
+		self.fused = fused
+		self.backend = backend
 		self.dimensions_list = TEN_DIMENSIONS
 
-		#load models
-		self.dim2model = {}
-		self.dim2embedding = {}
+		if self.is_cuda:
+			print(f'Torch version: {torch.__version__}')
+			print(f'Torch CUDA available : {torch.cuda.is_available()}')
+			if torch.cuda.is_available():
+				print(f'Torch current device : {torch.cuda.current_device()}')
+				print(f'Torch device count : {torch.cuda.device_count()}')
+				print(f'Torch device name : {torch.cuda.get_device_name(0)}')
+			else:
+				print('Cuda not available. Instantiated the TenDimensionsClassifier with CUDA=False')
+				self.is_cuda = False 
+		if self.backend != 'eager' and (self.fused or self.is_cuda):
+			print(f'The {self.backend} backend is not used by the fused engine and runs on CPU only, the models run in eager mode')
+			self.backend = 'eager'
 
+		#find the model of each dimension and the embedding it was trained on
+		self.dim2model_file = {}
+		self.dim2embedding_name = {}
 		for dim in self.dimensions_list:
-			model = LSTMClassifier(embedding_dim=300, hidden_dim=300)
-			if self.is_cuda:
-				print(f'Torch version: {torch.__version__}')
-				print(f'Torch CUDA available : {torch.cuda.is_available()}')
-				if torch.cuda.is_available():
-					print(f'Torch current device : {torch.cuda.current_device()}')
-					print(f'Torch device count : {torch.cuda.device_count()}')
-					print(f'Torch device name : {torch.cuda.get_device_name(0)}')
-					model.cuda()
-				else:
-					print('Cuda not available. Instantiated the TenDimensionsClassifier with CUDA=False')
-					self.is_cuda = False 
-			model.eval()
 			for modelname in os.listdir(self.models_dir):
-				if ('-best.lstm' in modelname) & (dim in modelname):
-					best_state = torch.load(join(self.models_dir, modelname), map_location='cpu')
-					model.load_state_dict(best_state)
-					if 'glove' in modelname:
-						em = self.em_glove
-					elif 'word2vec' in modelname:
-						em = self.em_word2vec
-					elif 'fasttext' in modelname:
-						em = self.em_fasttext
-					self.dim2model[dim] = model
-					self.dim2embedding[dim] = em
+				if ('-best.lstm' in modelname) & (dim in modelname) & modelname.endswith('.pth'):
+					self.dim2model_file[dim] = join(self.models_dir, modelname)
+					for emb_name in EMBEDDING_NAMES:
+						if emb_name in modelname:
+							self.dim2embedding_name[dim] = emb_name
 					break
 
+		#execution plan: the dimensions sharing an embedding space are scored on the same input tensor
+		self.embedding2dims = {}
+		for dim in self.dimensions_list:
+			if dim in self.dim2embedding_name:
+				self.embedding2dims.setdefault(self.dim2embedding_name[dim], []).append(dim)
+
+		#loaded embeddings and models, each one is loaded once under its own lock
+		self.embeddings = {}
+		self.dim2model = {}
+		self.embedding2fused = {}
+		self.load_locks = {key: threading.Lock() for key in list(EMBEDDING_NAMES) + list(self.dimensions_list) + ['fused-' + e for e in EMBEDDING_NAMES]}
+		if not lazy:
+			self.warmup()
+
+
+	@property
+	def em_glove(self):
+		return self.get_embedding('glove')
+
+	@property
+	def em_word2vec(self):
+		return self.get_embedding('word2vec')
+
+	@property
+	def em_fasttext(self):
+		return self.get_embedding('fasttext')
+
+
+	def _load_once(self, loaded, key, lock_key, load_fun):
+		value = loaded.get(key)
+		if value is None:
+			# concurrent callers wait for the first one to finish loading
+			with self.load_locks[lock_key]:
+				value = loaded.get(key)
+				if value is None:
+					value = load_fun(key)
+					loaded[key] = value
+		return value
+
+
+	def get_embedding(self, emb_name):
+		return self._load_once(self.embeddings, emb_name, emb_name, self._load_embedding)
+
+
+	def get_model(self, dim):
+		return self._load_once(self.dim2model, dim, dim, self._load_model)
+
+
+	def get_fused(self, emb_name):
+		return self._load_once(self.embedding2fused, emb_name, 'fused-' + emb_name, self._load_fused)
+
+
+	def _load_embedding(self, emb_name):
+		return ExtractWordEmbeddings(emb_name, emb_dir=self.embeddings_dir, store_name=self.embedding_store)
+
+
+	def _load_model(self, dim):
+		model_file = self.dim2model_file[dim]
+		model = LSTMClassifier(embedding_dim=300, hidden_dim=300)
+		model.load_state_dict(torch.load(model_file, map_location='cpu'))
+		if self.is_cuda:
+			model.cuda()
+		model.eval()
+		if self.backend != 'eager':
+			model = prepare_inference_model(model, self.backend, get_cache_file(model_file, self.backend), model_file)
+		return model
+
+
+	def _load_fused(self, emb_name):
+		return FusedLSTMClassifier([self.get_model(d) for d in self.embedding2dims[emb_name]]).eval()
+
+
+	def warmup(self, dimensions=None, background=False):
+		"""
+		Loads the embeddings and the models needed by the dimensions
+		@param dimensions: a string representing the dimension or a list of strings, None loads all dimensions
+		@param background: to load them in a daemon thread and return immediately
+		@return the thread if background=True
+		"""
+		if background:
+			thread = threading.Thread(target=self.warmup, args=(dimensions,), daemon=True)
+			thread.start()
+			return thread
+		dimensions = self._parse_input_dimensions(dimensions)
+		for emb_name, group_dims in self.embedding2dims.items():
+			group_dims = [d for d in group_dims if d in dimensions]
+			if group_dims:
+				self.get_embedding(emb_name)
+				if self.fused:
+					self.get_fused(emb_name)
+				else:
+					for dim in group_dims:
+						self.get_model(dim)
+
+
+	def share_memory(self):
+		"""
+		Loads everything and moves the embeddings and the model weights to shared memory,
+		so that the workers forked after it share them instead of copying them
+		"""
+		self.warmup()
+		for em in self.embeddings.values():
+			em.share_memory()
+		for model in list(self.dim2model.values()) + list(self.embedding2fused.values()):
+			try:
+				model.share_memory()
+			except Exception as e: # e.g. the packed weights of the int8 backends
+				print(f'Could not move the weights of {type(model).__name__} to shared memory: {e}')
+
 
 	def _parse_input_dimensions(self, d):
 		if d is None:
@@ -78,35 +194,21 @@ class TenDimensionsClassifier:
 	def compute_score(self, text, dimensions=None):
 		"""
 		Computed dimension(s) scores on the whole input text
-		@param text: the input text 
+		@param text: the input text or a list of texts
 		@param dimensions: a string representing the dimension or a list of strings for 
 		                   multiple dimensions. None triggers the computation of all dimensions
 		@return the confidence score for the selected dimension
 		        a dictionary dimension:score is returned if multiple dimensions were specified
 		        None (or dimension:None) is returned when the dimension could not be computed
+		        a list of the above is returned for a list of texts
 		"""
-		result = []
 		if isinstance(text, list):
 			text_list = text
 		elif isinstance(text, str):
 			text_list = [text]
 
-		for text in text_list:
-			dimension_scores = {d:None for d in self._parse_input_dimensions(dimensions)}
-			if text is not None and text != '':
-				for dim in dimension_scores:
-					try:
-						model = self.dim2model[dim]
-						em = self.dim2embedding[dim]
-						input_ = em.obtain_vectors_from_sentence(tokenize(text), True)
-						input_ = torch.tensor(input_).float().unsqueeze(0)
-						if self.is_cuda:
-							input_ = input_.cuda()
-						output = model(input_)
-						score = torch.sigmoid(output).item()
-						dimension_scores[dim] = score
-					except:
-						pass
+		result = []
+		for dimension_scores in self.compute_score_batch(text_list, dimensions):
 			if len(dimension_scores) == 1:
 				result.append(list(dimension_scores.values())[0])
 			else:
@@ -117,6 +219,68 @@ class TenDimensionsClassifier:
 			return result
 
 
+	def compute_score_batch(self, text_list, dimensions=None, batch_size=None):
+		"""
+		Computed dimension(s) scores on a list of texts
+		Each text is tokenized once and embedded once per embedding space. The texts are
+		sorted by length and padded in mini-batches, the embedded mini-batch then feeds
+		the forward pass of every dimension sharing that embedding
+		@param text_list: the list of input texts
+		@param dimensions: a string representing the dimension or a list of strings for 
+		                   multiple dimensions. None triggers the computation of all dimensions
+		@param batch_size: the maximum number of texts in a mini-batch, defaults to self.batch_size
+		@return a list with a dictionary dimension:score for each text
+		        dimension:None is returned when the dimension could not be computed
+		"""
+		batch_size = self.batch_size if batch_size is None else batch_size
+		dimensions = self._parse_input_dimensions(dimensions)
+		result = [{d:None for d in dimensions} for _ in text_list]
+
+		tokens = {}
+		with stage('tendims_tokenize'):
+			for i, text in enumerate(text_list):
+				if text is not None and text != '':
+					try:
+						tokens[i] = tokenize(text)
+					except:
+						pass
+		order = sorted(tokens, key=lambda i: len(tokens[i]))
+
+		with torch.no_grad():
+			for emb_name, group_dims in self.embedding2dims.items():
+				group_dims = [d for d in group_dims if d in dimensions]
+				if not group_dims or not order:
+					continue
+				em = self.get_embedding(emb_name)
+				for start in range(0, len(order), batch_size):
+					batch_ids = order[start:start+batch_size]
+					try:
+						with stage('tendims_embedding'):
+							input_, lengths = em.obtain_vectors_from_sentences([tokens[i] for i in batch_ids], True)
+							input_, lengths = torch.from_numpy(input_), torch.from_numpy(lengths)
+							if self.is_cuda:
+								input_ = input_.cuda()
+						with stage('tendims_lstm'):
+							dim2scores = self._forward_group(emb_name, group_dims, input_, lengths)
+					except:
+						continue
+					for dim, scores in dim2scores.items():
+						for i, score in zip(batch_ids, scores):
+							result[i][dim] = score
+		return result
+
+
+	def _forward_group(self, emb_name, group_dims, input_, lengths):
+		"""
+		Runs the models of the dimensions sharing the embedding emb_name on one embedded mini-batch
+		@return a dictionary dimension:list of scores
+		"""
+		if self.fused:
+			output = torch.sigmoid(self.get_fused(emb_name)(input_, lengths))
+			return {dim:output[:, j].tolist() for j, dim in enumerate(self.embedding2dims[emb_name]) if dim in group_dims}
+		return {dim:torch.sigmoid(self.get_model(dim)(input_, lengths)).view(-1).tolist() for dim in group_dims}
+
+
 	def compute_score_split(self, text, dimensions=None, min_tokens=3, return_all=False):
 		"""
 		Computed dimension(s) scores on each sentence of the input text and returns aggreagated 
@@ -136,25 +300,31 @@ class TenDimensionsClassifier:
 			text_list = text
 		elif isinstance(text, str):
 			text_list = [text]
+		dimensions = self._parse_input_dimensions(dimensions)
 
-		for text in text_list:
-			dimension_scores = {d:(None,None) for d in self._parse_input_dimensions(dimensions)}
+		# the qualifying sentences of all the texts are scored together in a single batch
+		sentences = []
+		sentence_owners = []
+		for i, text in enumerate(text_list):
 			if text is not None and text != '':
-				for dim in dimension_scores:
-					scores = []
-					try:
-						sentences = sent_tokenize(text)
-					except:
-						sentences = [text]
-
-					for sent in sentences:
-						if len(sent) >= min_tokens:
-							try:
-								score = self.compute_score(sent, dim)
-								if score is not None:
-									scores.append(score)
-							except:
-								pass
+				try:
+					text_sentences = sent_tokenize(text)
+				except:
+					text_sentences = [text]
+				for sent in text_sentences:
+					if len(sent) >= min_tokens:
+						sentences.append(sent)
+						sentence_owners.append(i)
+		text2scores = [{d:[] for d in dimensions} for _ in text_list]
+		for i, sentence_scores in zip(sentence_owners, self.compute_score_batch(sentences, dimensions)):
+			for dim, score in sentence_scores.items():
+				if score is not None:
+					text2scores[i][dim].append(score)
+
+		for text, dim2scores in zip(text_list, text2scores):
+			dimension_scores = {d:(None,None) for d in dimensions}
+			if text is not None and text != '':
+				for dim, scores in dim2scores.items():
 					if scores:
 						if return_all:
 							dimension_scores[dim] = scores
@@ -173,4 +343,3 @@ class TenDimensionsClassifier:
 			return result[0]
 		else:
 			return result
-
@@ -0,0 +1,103 @@
+"""
+Per-request stage timings, reported in the Server-Timing header and in the ?profile=1 section.
+stage(name) is a no-op unless a timer was started for the current request, so the instrumented
+hot paths only pay a context variable lookup when the timings are off.
+The stages running on other threads are only timed when the thread runs in a copy of the request context
+(contextvars.copy_context().run), their times add up, so the stages can sum to more than the request time
+"""
+import io
+import re
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import contextvars
+
+
+_current_timer = contextvars.ContextVar('current_timer', default=None)
+_null_stage = contextlib.nullcontext()
+
+
+class RequestTimer:
+    def __init__(self):
+        self.stages = {}
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, name, duration):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + duration
+
+    def get_stages_ms(self):
+        with self.lock:
+            stages = {name: duration * 1000 for name, duration in self.stages.items()}
+        stages['total'] = (time.perf_counter() - self.start) * 1000
+        return stages
+
+    def server_timing(self):
+        # the metric names of Server-Timing are tokens
+        return ", ".join(f"{re.sub('[^A-Za-z0-9_.-]', '_', name)};dur={duration:.2f}" for name, duration in self.get_stages_ms().items())
+
+
+class _Stage:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def stage(name):
+    """
+    Context manager adding the time of its block to the stage name of the current request
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        return _null_stage
+    return _Stage(timer, name)
+
+
+def start_timer():
+    """
+    @return the timer of the current request
+    """
+    timer = RequestTimer()
+    _current_timer.set(timer)
+    return timer
+
+
+def stop_timer():
+    # the server threads are reused across requests
+    _current_timer.set(None)
+
+
+def start_profiler():
+    """
+    @return the running profiler, None if another one is already running (Python >= 3.12 allows one at a time)
+    """
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
+
+
+def stop_profiler(profiler, top=30):
+    """
+    Stops the profiler (it only samples the thread that started it)
+    @return the top functions by cumulative time, in the pstats text format
+    """
+    profiler.disable()
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(top)
+    return output.getvalue()